@@ -25,7 +25,7 @@
 
 from __future__ import print_function
 
-import collections, ctypes, json, os, random, re, shutil, signal, socket, subprocess, tempfile, threading, time, urllib
+import asyncio, codecs, collections, concurrent.futures, ctypes, fnmatch, gzip, hashlib, itertools, json, mimetypes, os, re, select, shutil, signal, socket, subprocess, tempfile, threading, time
 try:
   import bottle
   import react.jsx
@@ -38,9 +38,13 @@ try:
 except NameError:
   basestring = str
 try:
-  from urllib.request import urlopen, urlretrieve
+  from urllib.request import urlopen
 except ImportError:
-  from urllib import urlopen, urlretrieve
+  from urllib2 import urlopen
+try:
+  import http.client as httplib
+except ImportError:
+  import httplib
 
 
 __version__='16.2.3'
@@ -53,6 +57,27 @@ try:
 except ImportError:
   pass
 
+BROTLI_AROUND = False
+try:
+  import brotli
+  BROTLI_AROUND = True
+except ImportError:
+  pass
+
+ORJSON_AROUND = False
+try:
+  import orjson
+  ORJSON_AROUND = True
+except ImportError:
+  pass
+
+RJSMIN_AROUND = False
+try:
+  import rjsmin
+  RJSMIN_AROUND = True
+except ImportError:
+  pass
+
 
 
 __ALL__ = ['BottleReact','__version__']
@@ -68,26 +93,81 @@ def set_pdeathsig(sig = signal.SIGTERM):
         return libc.prctl(1, sig)
     return callable
 
+# the pdeathsig fires when the *thread* that forked the child exits, not the
+# process, so children are always started from one long-lived thread
+_spawner = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+def _popen(*args, **kwargs):
+  return _spawner.submit(subprocess.Popen, *args, **kwargs).result()
+
 
 class BottleReact(object):
  
-  def __init__(self, app, prod=False, jsx_path='jsx', asset_path='assets', work_path='/tmp/bottlereact', verbose=None, default_render_html_kwargs=None, harmony=True, render_server=None):
+  def __init__(self, app, prod=False, jsx_path='jsx', asset_path='assets', work_path='/tmp/bottlereact', verbose=None, default_render_html_kwargs=None, harmony=True, render_server=None, render_pool_min=1, render_pool_max=1, render_pool_queue_depth=1, render_shared_context=False, render_max_contexts=None, render_cache_size=None, render_cache_bytes=None, render_cache_ttl=None, render_start_timeout=30, prewarm=None, build_workers=None, ext_lock_file=None, offline=False, fetch_workers=8, fetch_timeout=30, dev_transpile=False, watch=False, watch_interval=1, bundle=False, bundle_vendor=None, precompress=False, minify=False, asset_cache_bytes=None, compile_templates=False, metrics=False, metrics_path=None, on_timing=None, render_supervise_interval=None, render_recycle_after=None, render_recycle_rss=None, render_pool_idle_timeout=60, render_timeout=30):
     self.app = app
     self.prod = prod
     self._render_server = render_server
     self._inited_render_server = False
+    self.render_pool_min = max(1, render_pool_min)
+    self.render_pool_max = max(self.render_pool_min, render_pool_max)
+    self.render_pool_queue_depth = render_pool_queue_depth
+    self.render_pool_idle_timeout = render_pool_idle_timeout
+    self.render_shared_context = render_shared_context
+    self.render_max_contexts = render_max_contexts
+    self.render_start_timeout = render_start_timeout
+    self.render_timeout = render_timeout
+    self.render_recycle_after = render_recycle_after
+    self.render_recycle_rss = render_recycle_rss
+    if render_supervise_interval is None and (render_recycle_after or render_recycle_rss):
+      render_supervise_interval = 5
+    self.render_supervise_interval = render_supervise_interval
+    self._supervisor = None
+    self._metrics = _Metrics(on_timing) if metrics or metrics_path or on_timing else None
+    self._render_cache = None
+    if render_cache_size or render_cache_bytes:
+      self._render_cache = _RenderCache(render_cache_size, render_cache_bytes, render_cache_ttl)
     if render_server:
       self._init_render_server()
     self.verbose = not prod if verbose is None else verbose
     self.default_render_html_kwargs = default_render_html_kwargs
     self.jsx_path = jsx_path
+    self.work_path = work_path
     self.hashed_path = os.path.join(work_path, 'hashed-assets')
     self.genned_path = os.path.join(work_path, 'genned-assets')
     self.ext_path = os.path.join(work_path, 'ext-assets')
+    self.socket_path = os.path.join(work_path, 'sockets')
+    self._short_socket_path = None
     self.asset_path = asset_path
     self.harmony = harmony
+    self.build_workers = build_workers or os.cpu_count() or 1
+    self.ext_lock_file = ext_lock_file
+    self.offline = offline
+    self.fetch_workers = fetch_workers
+    self.fetch_timeout = fetch_timeout
+    self.dev_transpile = dev_transpile and not prod
+    self._transpiled = {} # jsx fn -> (source hash, javascript)
+    self.watch_interval = watch_interval
+    self.bundle = bundle and prod
+    self.bundle_vendor = set(bundle_vendor or [])
+    self._bundles = {} # deps -> bundled deps
+    self._inline_cache = {} # (hashed fn, max size) -> content or None
+    self.precompress = precompress and prod
+    self.minify = minify and prod
+    self._asset_cache = _RenderCache(max_bytes=asset_cache_bytes) if asset_cache_bytes and prod else None
+    if self.minify and not RJSMIN_AROUND:
+      raise Exception('Python package "rjsmin" was not found (but is required for minify=True).\nPlease install it with: pip install rjsmin')
+    self._templates = _RenderCache(max_size=256) if compile_templates else None # (template, kwargs...) -> segments, () if not compilable
+    self._templates_seen = _RenderCache(max_size=1024) if compile_templates else None # keys rendered once, not compiled yet
+    self._watcher = None
     self._reqs = collections.defaultdict(list)
-    self._ctxs = {}
+    self._closures = {} # jsx file -> its transitive requirements, then itself
+    self._dep_lists = {} # unique files (in tree order) -> deps
+    self._classes_json = {} # class names -> browser safe JSON
+    self._deps_html_memo = {} # (deps, kwargs...) -> (html, Link header)
+    self._ctxs = collections.OrderedDict() # LRU order, oldest first
+    self._ctx_futures = {} # deps -> future of the pool being started
+    self._jsx_files = []
+    self._shared_deps = None
     self._ctx_lock = threading.Lock()
     
     if not os.path.isdir(self.jsx_path):
@@ -97,7 +177,20 @@ class BottleReact(object):
       if self.prod:
         @app.route('/__br_assets__/<path:path>')
         def _serve__br_assets(path):
-          response = flask.send_from_directory(self.hashed_path, path)
+          # byte ranges are served from the uncompressed file
+          request_headers = flask.request.headers
+          fn, encoding = self._precompressed_variant(path, '' if 'Range' in request_headers else request_headers.get('Accept-Encoding', ''))
+          cached = self._serve_cached_asset(path, fn, encoding, request_headers.get('If-None-Match'))
+          if cached:
+            status, headers, body = cached
+            return flask.Response(body, status=status, headers=headers)
+          if encoding:
+            response = flask.send_from_directory(self.hashed_path, fn, mimetype=mimetypes.guess_type(path)[0])
+            response.headers['Content-Encoding'] = encoding
+          else:
+            response = flask.send_from_directory(self.hashed_path, path)
+          if self.precompress:
+            response.headers['Vary'] = 'Accept-Encoding'
           response.headers["Cache-Control"] = "public, max-age=31536000" # one year
           return response
       else:
@@ -105,6 +198,8 @@ class BottleReact(object):
         def _serve__br_assets(path):
           if path=='bottlereact.js':
             return flask.Response(BOTTLEREACT_JS, mimetype='text/javascript')
+          elif self.dev_transpile and path in self._jsx_files:
+            return flask.Response(self._transpile(path), mimetype='text/javascript')
           elif path.endswith('.jsx'):
             response = flask.make_response(flask.send_from_directory(self.jsx_path, path, mimetype='text/babel'))
             return response
@@ -114,7 +209,20 @@ class BottleReact(object):
       if self.prod:
         @app.get('/__br_assets__/<path:path>')
         def _serve__br_assets(path):
-          response = bottle.static_file(path, root=self.hashed_path)
+          # byte ranges are served from the uncompressed file
+          request_headers = bottle.request.headers
+          fn, encoding = self._precompressed_variant(path, '' if 'Range' in request_headers else request_headers.get('Accept-Encoding', ''))
+          cached = self._serve_cached_asset(path, fn, encoding, request_headers.get('If-None-Match'))
+          if cached:
+            status, headers, body = cached
+            return bottle.HTTPResponse(body, status, headers)
+          if encoding:
+            response = bottle.static_file(fn, root=self.hashed_path, mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+            if response.status_code==200: response.set_header('Content-Encoding', encoding)
+          else:
+            response = bottle.static_file(path, root=self.hashed_path)
+          if self.precompress:
+            response.set_header('Vary', 'Accept-Encoding')
           response.set_header("Cache-Control", "public, max-age=31536000") # one year
           return response
       else:
@@ -123,43 +231,64 @@ class BottleReact(object):
           if path=='bottlereact.js':
             bottle.response.set_header('Content-Type', 'text/javascript')
             return BOTTLEREACT_JS
+          elif self.dev_transpile and path in self._jsx_files:
+            bottle.response.set_header('Content-Type', 'text/javascript')
+            return self._transpile(path)
           elif path.endswith('.jsx'):
             return bottle.static_file(path, root=self.jsx_path, mimetype='text/babel')
           else:
             return bottle.static_file(path, root=self.asset_path)
 
+    if metrics_path:
+      if FLASK_AROUND and isinstance(app, flask.app.Flask):
+        @app.route(metrics_path)
+        def _serve__br_metrics():
+          return flask.Response(self.metrics_text(), content_type=_PROMETHEUS_CONTENT_TYPE)
+      else:
+        @app.get(metrics_path)
+        def _serve__br_metrics():
+          bottle.response.set_header('Content-Type', _PROMETHEUS_CONTENT_TYPE)
+          return self.metrics_text()
 
-    # load all JSX files
-    classes_by_file = collections.defaultdict(list)
+    # load all JSX files (files unchanged since the last startup come from the index)
+    self._class_fns = {}
+    classes_by_file = {}
+    if not os.path.isdir(self.work_path):
+      os.makedirs(self.work_path)
+    index_fn = os.path.join(self.work_path, 'jsx-index.json')
+    try:
+      with open(index_fn) as f:
+        index = json.load(f)
+    except (IOError, ValueError):
+      index = {}
+    # other jsx_paths may share this work_path, keep their files' entries
+    jsx_dir = os.path.abspath(self.jsx_path)
+    new_index = {path:entry for path, entry in index.items() if os.path.dirname(path) != jsx_dir and os.path.exists(path)}
     for fn in sorted(os.listdir(self.jsx_path)):
       if not fn.endswith('.jsx'): continue
-      with open(os.path.join(self.jsx_path, fn), 'r') as f:
-        for line in f.readlines():
-          if 'React.createClass' in line:
-            if '=' not in line: continue
-            react_class = line.split('=')[0].strip().split()[-1]
-            classes_by_file[fn].append(react_class)
-            self.__dict__[react_class] = _ReactClass(react_class, fn)
-          if 'createReactClass' in line:
-            if '=' not in line: continue
-            react_class = line.split('=')[0].strip().split()[-1]
-            classes_by_file[fn].append(react_class)
-            self.__dict__[react_class] = _ReactClass(react_class, fn)
-          if 'extends React.Component' in line:
-            if 'class' not in line: continue
-            react_class = line[line.find('class')+5:line.find('extends')].strip()
-            classes_by_file[fn].append(react_class)
-            self.__dict__[react_class] = _ReactClass(react_class, fn)
-          if line.startswith('// require '):
-            req = line[len('// require '):].strip()
-            self._reqs[fn].append(req)
+      self._jsx_files.append(fn)
+      path = os.path.abspath(os.path.join(self.jsx_path, fn))
+      st = os.stat(path)
+      entry = index.get(path)
+      if not entry or entry[0]!=st.st_size or entry[1]!=st.st_mtime_ns:
+        entry = [st.st_size, st.st_mtime_ns] + list(_scan_jsx_file(path))
+      new_index[path] = entry
+      classes, reqs = entry[2], entry[3]
+      if classes: classes_by_file[fn] = classes
+      if reqs: self._reqs[fn] = list(reqs)
+      for react_class in classes:
+        self._class_fns[react_class] = fn
+    if new_index != index:
+      _atomic_write(index_fn, json.dumps(new_index))
+    self._compute_closures()
 
     if self.verbose:
-      print('BR classes by file:', dict(classes_by_file.items()))
+      print('BR classes by file:', classes_by_file)
 
     self._fn2hash = {}
+    self._manifest = {}
     if prod:
-      transformer = react.jsx.JSXTransformer()
+      self._load_manifest()
     
       # confirm tmp paths exist
       for path in [self.hashed_path, self.genned_path, self.ext_path]:
@@ -170,44 +299,291 @@ class BottleReact(object):
       self._fn2hash = self._load_fn_to_hash_mapping(self.asset_path, '*', dest=self.hashed_path)
 
       # download external resources
-      for fn, deps in self._reqs.items():
-        for dep in deps:
-          if dep.startswith('http://') or dep.startswith('https://'):
-            local_path = os.path.join(self.ext_path, _make_string_fn_safe(dep))
-            if not os.path.isfile(local_path):
-              if self.verbose: print('BR downloading:', dep)
-              try:
-                urlretrieve(dep, local_path)
-              except urllib.error.HTTPError as e:
-                print('BR warning could not download', dep, e)
+      self._fetch_ext_deps()
       self._fn2hash.update(self._load_fn_to_hash_mapping(self.ext_path, '*', dest=self.hashed_path))
             
       # jsx assets
       jsx2hash = self._load_fn_to_hash_mapping(self.jsx_path, '*.jsx', dest=self.genned_path)
+      todo = []
       for jsx_fn, jsx_hashed_fn in jsx2hash.items():
-        jsx_converted_fn = os.path.join(self.genned_path, jsx_hashed_fn[:-1])
+        jsx_converted_fn = os.path.join(self.genned_path, self._converted_fn(jsx_hashed_fn))
         if not os.path.exists(jsx_converted_fn) or os.stat(jsx_converted_fn).st_size==0:
-          transformer.transform(os.path.join(self.genned_path, jsx_hashed_fn), js_path=jsx_converted_fn, harmony=self.harmony)
+          todo.append((jsx_fn, os.path.join(self.genned_path, jsx_hashed_fn), jsx_converted_fn))
+      self._transform_jsx_files(todo)
 
-      # bottlereact.js
-      with open(os.path.join(self.genned_path, 'bottlereact.js'),'w') as f:
-        f.write(BOTTLEREACT_JS)
-        f.write('\nbottlereact._assets = ')
-        json.dump(self._fn2hash, f)
-        f.write(';\n')
+      # bottlereact.js (only rewritten if changed, so the manifest can skip rehashing it)
+      bottlereact_js = BOTTLEREACT_JS +'\nbottlereact._assets = '+ json.dumps(self._fn2hash, sort_keys=True) +';\n'
+      bottlereact_js_fn = os.path.join(self.genned_path, 'bottlereact.js')
+      try:
+        with open(bottlereact_js_fn) as f:
+          changed = f.read() != bottlereact_js
+      except IOError:
+        changed = True
+      if changed:
+        _atomic_write(bottlereact_js_fn, bottlereact_js)
 
       # add the jsx files (which are only used server side, so not written to 'bottlereact.js')
       jsxjs2hash = self._load_fn_to_hash_mapping(self.genned_path, '*.js', dest=self.hashed_path)
       for k,v in jsx2hash.items():
-        self._fn2hash[k] = jsxjs2hash[v[:-1]]
+        self._fn2hash[k] = jsxjs2hash[self._converted_fn(v)]
 
       # get the hashed name of 'bottlereact.js'
       self._fn2hash['bottlereact.js'] = jsxjs2hash['bottlereact.js']
 
       if self.verbose: print('BR file hashes:', self._fn2hash)
 
+      if self.precompress:
+        for fn in os.listdir(self.hashed_path):
+          self._precompress_file(os.path.join(self.hashed_path, fn))
+
+      self._save_manifest()
+
+      if self._asset_cache is not None:
+        self._preload_asset_cache()
+
     if self.verbose: print('BR file requirements: ', dict(self._reqs.items()))
 
+    if prewarm:
+      self.prewarm(None if prewarm is True else prewarm)
+
+    if watch and not prod:
+      self.start_watching()
+
+    if self.render_supervise_interval:
+      self.start_supervising()
+
+  def start_supervising(self):
+    '''
+      Checks the render servers every render_supervise_interval seconds (in a
+      background thread), replacing dead ones and ones that don't answer a
+      ping within render_timeout, and recycling those past
+      render_recycle_after renders or render_recycle_rss bytes of memory.
+    '''
+    if self._supervisor: return
+    self._supervisor = threading.Event()
+    def f(stop):
+      while not stop.wait(self.render_supervise_interval):
+        try:
+          self._supervise()
+        except Exception as e:
+          print('BR supervisor error:', e)
+    threading.Thread(target=f, args=(self._supervisor,), daemon=True).start()
+
+  def stop_supervising(self):
+    if self._supervisor:
+      self._supervisor.set()
+      self._supervisor = None
+
+  def _supervise(self):
+    with self._ctx_lock:
+      pools = list(self._ctxs.values())
+    for pool in pools:
+      pool.reap_idle()
+      for worker in list(pool.workers):
+        if worker.draining: continue
+        if worker.child.poll() is not None:
+          reason = 'context_respawns'
+        elif self.render_timeout and not worker.ping(self.render_timeout):
+          # one that just died refuses the ping before poll() notices
+          try:
+            worker.child.wait(.1)
+            reason = 'context_respawns'
+          except subprocess.TimeoutExpired:
+            reason = 'context_hangs'
+        elif self.render_recycle_after and worker.renders >= self.render_recycle_after:
+          reason = 'context_recycles'
+        elif self.render_recycle_rss and (_rss(getattr(worker.child, 'pid', None)) or 0) > self.render_recycle_rss:
+          reason = 'context_recycles'
+        else:
+          continue
+        if self.verbose: print('BR replacing nodejs server at unix:%s (%s)' % (worker.address, reason))
+        if self._metrics: self._metrics.count(reason)
+        # a hung worker won't finish its renders, so it's not drained
+        pool.replace(worker, dead=reason == 'context_hangs')
+
+  def start_watching(self):
+    '''
+      Watches jsx_path and asset_path (in a background thread) and rebuilds the
+      render contexts that use any changed file.
+    '''
+    if self._watcher: return
+    self._watcher = threading.Event()
+    self._watched = self._snapshot_files()
+    def f(stop):
+      while not stop.wait(self.watch_interval):
+        try:
+          self._check_for_changes()
+        except Exception as e:
+          print('BR watcher error:', e)
+    threading.Thread(target=f, args=(self._watcher,), daemon=True).start()
+
+  def stop_watching(self):
+    if self._watcher:
+      self._watcher.set()
+      self._watcher = None
+
+  def _snapshot_files(self):
+    ret = {}
+    for fn in os.listdir(self.jsx_path):
+      if not fn.endswith('.jsx'): continue
+      st = os.stat(os.path.join(self.jsx_path, fn))
+      ret[fn] = st.st_size, st.st_mtime_ns
+    if os.path.isdir(self.asset_path):
+      for root, dirs, files in os.walk(self.asset_path):
+        for name in files:
+          path = os.path.join(root, name)
+          st = os.stat(path)
+          ret[os.path.relpath(path, self.asset_path)] = st.st_size, st.st_mtime_ns
+    return ret
+
+  def _check_for_changes(self):
+    snapshot = self._snapshot_files()
+    changed = set(fn for fn in set(snapshot) | set(self._watched) if snapshot.get(fn) != self._watched.get(fn))
+    self._watched = snapshot
+    if not changed: return changed
+    if self.verbose: print('BR changed files:', sorted(changed))
+    reqs_changed = set()
+    for fn in changed:
+      if fn.endswith('.jsx') and os.path.isfile(os.path.join(self.jsx_path, fn)):
+        classes, reqs = _scan_jsx_file(os.path.join(self.jsx_path, fn))
+        if fn not in self._jsx_files:
+          self._jsx_files.append(fn)
+          self._jsx_files.sort()
+          reqs_changed.add(fn)
+        for name, class_fn in list(self._class_fns.items()):
+          if class_fn==fn and name not in classes:
+            del self._class_fns[name]
+            self.__dict__.pop(name, None)
+        for name in classes:
+          self._class_fns[name] = fn
+          if name in self.__dict__ and self.__dict__[name].fn != fn:
+            del self.__dict__[name]
+        if self._reqs.get(fn, []) != reqs:
+          self._reqs[fn] = reqs
+          reqs_changed.add(fn)
+      elif fn in self._jsx_files and not os.path.exists(os.path.join(self.jsx_path, fn)):
+        self._jsx_files.remove(fn)
+        self._reqs.pop(fn, None)
+        reqs_changed.add(fn)
+    self._deps_html_memo = {}
+    # cache keys are hashes, so there's no telling which entries used the changed files
+    if self._render_cache is not None:
+      self._render_cache.clear()
+    if reqs_changed:
+      self._shared_deps = None
+      self._closures = {}
+      self._dep_lists = {}
+      self._compute_closures()
+    with self._ctx_lock:
+      affected = [(deps, pool) for deps, pool in self._ctxs.items() if changed.intersection(deps)]
+    for deps, pool in affected:
+      if reqs_changed.intersection(deps):
+        # new requests will have different deps, so there's nothing to rebuild
+        with self._ctx_lock:
+          if self._ctxs.get(deps) is pool: del self._ctxs[deps]
+        pool.close()
+      else:
+        threading.Thread(target=self._rebuild_js_context, args=(deps, pool), daemon=True).start()
+    return changed
+
+  def _rebuild_js_context(self, deps, old_pool):
+    # the old context keeps serving until the new one is ready
+    if self.verbose: print('BR rebuilding render context', deps)
+    try:
+      pool = self._new_pool(deps)
+    except Exception as e:
+      print('BR could not rebuild render context', deps, e)
+      return
+    with self._ctx_lock:
+      if self._ctxs.get(deps) is old_pool:
+        self._ctxs[deps] = pool
+      else:
+        old_pool, pool = pool, None # replaced or evicted meanwhile
+    # drop anything the old context rendered while this one was starting
+    if pool and self._render_cache is not None:
+      self._render_cache.clear()
+    old_pool.close()
+
+  def _fetch_ext_deps(self):
+    urls = _dedup([dep for fn in sorted(self._reqs) for dep in self._reqs[fn] if dep.startswith('http://') or dep.startswith('https://')])
+    if not urls: return
+    pins = {}
+    if self.ext_lock_file:
+      with open(self.ext_lock_file) as f:
+        pins = json.load(f)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=self.fetch_workers) as executor:
+      list(executor.map(lambda url: self._fetch_ext_dep(url, pins.get(url)), urls))
+
+  def _fetch_ext_dep(self, url, pinned_hash=None):
+    local_path = os.path.join(self.ext_path, _make_string_fn_safe(url))
+    if os.path.isfile(local_path):
+      if pinned_hash is None or _sha256_file(local_path) == pinned_hash: return
+      print('BR warning cached', url, 'does not match its pinned hash')
+      os.remove(local_path)
+    if self.offline:
+      print('BR warning offline and', url, 'is not in', self.ext_path)
+      return
+    if self.verbose: print('BR downloading:', url)
+    try:
+      with urlopen(url, timeout=self.fetch_timeout) as f:
+        data = f.read()
+    except Exception as e:
+      print('BR warning could not download', url, e)
+      return
+    if pinned_hash is not None and hashlib.sha256(data).hexdigest() != pinned_hash:
+      raise Exception('BR %s does not match its pinned hash %s (from %s)' % (url, pinned_hash, self.ext_lock_file))
+    _atomic_write(local_path, data)
+
+  def __getattr__(self, name):
+    # _ReactClass objects are made on first use
+    class_fns = self.__dict__.get('_class_fns')
+    if class_fns is None or name not in class_fns:
+      raise AttributeError(name)
+    react_class = _ReactClass(name, class_fns[name])
+    self.__dict__[name] = react_class
+    return react_class
+
+  def _transpile(self, fn):
+    '''
+      Javascript for a jsx file (in dev mode), cached in memory and in
+      work_path by the hash of its source, so only changed files are transformed.
+    '''
+    js_path = os.path.join(self.jsx_path, fn)
+    with open(js_path, 'rb') as f:
+      hsh = hashlib.sha256(f.read()).hexdigest()[:16]
+    cached = self._transpiled.get(fn)
+    if cached and cached[0]==hsh:
+      return cached[1]
+    cache_path = os.path.join(self.work_path, 'transpile-cache')
+    if not os.path.isdir(cache_path):
+      os.makedirs(cache_path)
+    cache_fn = os.path.join(cache_path, '%s-%s%s' % (hsh, 'h-' if self.harmony else '', fn[:-1]))
+    if not os.path.exists(cache_fn):
+      if self.verbose: print('BR transforming', js_path)
+      error = _transform_jsx(js_path, cache_fn, self.harmony)
+      if error:
+        raise Exception('BR could not transform %s: %s' % (fn, error))
+    with open(cache_fn) as f:
+      js = f.read()
+    self._transpiled[fn] = hsh, js
+    return js
+
+  def _transform_jsx_files(self, todo):
+    '''
+      Transforms [(jsx_fn, src, dest)] into javascript, across build_workers processes.
+    '''
+    if not todo: return
+    if self.verbose: print('BR transforming %i jsx files' % len(todo))
+    args = [(src, dest, self.harmony, self.minify) for jsx_fn, src, dest in todo]
+    if self.build_workers > 1 and len(todo) > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=min(self.build_workers, len(todo))) as executor:
+        results = list(executor.map(_transform_jsx, *zip(*args)))
+    else:
+      results = [_transform_jsx(*a) for a in args]
+    errors = ['  %s: %s' % (jsx_fn, error) for (jsx_fn, src, dest), error in zip(todo, results) if error]
+    if errors:
+      raise Exception('BR could not transform %i jsx file(s):\n%s' % (len(errors), '\n'.join(errors)))
+
   def _init_render_server(self):
     if self._inited_render_server: return
     try:
@@ -227,21 +603,44 @@ class BottleReact(object):
       raise Exception('Node.js package "node-jsdom" was not found (but is required for server side rendering).\nPlease install it with: sudo npm install -g node-jsdom')
     self._inited_render_server = True
 
+  def _compute_closures(self):
+    for fn in self._jsx_files:
+      self._closure(fn)
+
+  def _closure(self, fn, path=()):
+    # fn's "// require"s (depth first, each before the files that need it), then fn
+    ret = self._closures.get(fn)
+    if ret is None:
+      if fn in path:
+        cycle = path[path.index(fn):] + (fn,)
+        raise Exception('Circular "// require" in %s: %s' % (self.jsx_path, ' -> '.join(cycle)))
+      path += (fn,)
+      output = []
+      seen = set()
+      for fn2 in self._reqs.get(fn, ()):
+        for dep in self._closure(fn2, path):
+          if dep not in seen:
+            output.append(dep)
+            seen.add(dep)
+      if fn not in seen: output.append(fn)
+      ret = self._closures[fn] = tuple(output)
+    return ret
+
   def _build_dep_list(self, files):
-    output = ['bottlereact.js']
-    if not self.prod:
-      output.append(BABEL_CORE)
-    seen = set(output)
-    for fn in files:
-      self._build_dep_list_internal(fn, seen, output)
-    return output
-
-  def _build_dep_list_internal(self, fn, seen, output):
-    if fn in seen: return
-    for fn2 in self._reqs[fn]:
-      self._build_dep_list_internal(fn2, seen, output)
-    output.append(fn)
-    seen.add(fn)
+    files = tuple(_dedup(files))
+    deps = self._dep_lists.get(files)
+    if deps is None:
+      output = ['bottlereact.js']
+      if not self.prod and not self.dev_transpile:
+        output.append(BABEL_CORE)
+      seen = set(output)
+      for fn in files:
+        for dep in self._closure(fn):
+          if dep not in seen:
+            output.append(dep)
+            seen.add(dep)
+      deps = self._dep_lists[files] = tuple(output)
+    return list(deps)
     
   def get_asset_path(self, fn):
     return '/__br_assets__/%s' % self._fn2hash.get(fn, fn)
@@ -250,22 +649,43 @@ class BottleReact(object):
     path = os.path.abspath(path)
     ret = {}
     if not os.path.isdir(path): return ret
-    if not os.listdir(path): return ret
-    output = subprocess.check_output(['find %s -name \'%s\' -type f -print0 | xargs -0 -n 100 sha256sum' % (path, selector)], shell=True)
-    for line in output.decode("utf8").split('\n'):
-      line = line.strip()
-      if not line: continue
-      hsh, fn = line.split('  ', 1)
-      hsh = hsh[:16]
-      base_fn = os.path.relpath(fn, path)
-      hashed_fn = '%s-%s' % (hsh, base_fn.replace('/','__'))
-      ret[base_fn] = hashed_fn
-      tmp_fn = os.path.join(dest, hashed_fn)
-      if not os.path.exists(tmp_fn):
-        shutil.copy(fn, tmp_fn)
-        if self.verbose: print('BR copied', fn, 'to', tmp_fn)
+    for root, dirs, files in os.walk(path):
+      for name in files:
+        if not fnmatch.fnmatch(name, selector): continue
+        fn = os.path.join(root, name)
+        if os.path.islink(fn): continue
+        hsh = self._hash_file(fn)
+        base_fn = os.path.relpath(fn, path)
+        hashed_fn = '%s-%s' % (hsh, base_fn.replace('/','__'))
+        ret[base_fn] = hashed_fn
+        tmp_fn = os.path.join(dest, hashed_fn)
+        if not os.path.exists(tmp_fn):
+          shutil.copy(fn, tmp_fn)
+          if self.verbose: print('BR copied', fn, 'to', tmp_fn)
     return ret
-  
+
+  def _hash_file(self, fn):
+    # files whose size and mtime haven't changed since the last startup aren't re-read
+    st = os.stat(fn)
+    entry = self._manifest.get(fn)
+    if entry and entry[0]==st.st_size and entry[1]==st.st_mtime_ns:
+      return entry[2]
+    hsh = _sha256_file(fn)[:16]
+    self._manifest[fn] = [st.st_size, st.st_mtime_ns, hsh]
+    return hsh
+
+  def _load_manifest(self):
+    try:
+      with open(os.path.join(self.work_path, 'manifest.json')) as f:
+        self._manifest = json.load(f)
+    except (IOError, ValueError):
+      self._manifest = {}
+
+  def _save_manifest(self):
+    # drop files that have gone away
+    self._manifest = {fn:v for fn,v in self._manifest.items() if os.path.exists(fn)}
+    _atomic_write(os.path.join(self.work_path, 'manifest.json'), json.dumps(self._manifest))
+
   def calc_render_html_kwargs(self, kwargs):
     if self.default_render_html_kwargs is None:
       return kwargs
@@ -277,22 +697,87 @@ class BottleReact(object):
     return ret
   
   def get_js_context(self, deps):
-    port, child = self._ctxs.get(deps, (None, None))
-    if port: return port
+    if self.render_shared_context:
+      # one context with every jsx file (and their requirements) preloaded
+      deps = self._get_shared_deps()
+    pool = self._ctxs.get(deps)
+    if pool and not self.render_max_contexts: return pool
+    with self._ctx_lock:
+      pool = self._ctxs.get(deps)
+      if pool:
+        self._ctxs.move_to_end(deps)
+        return pool
+      future = self._ctx_futures.get(deps)
+      starting = future is None
+      if starting:
+        future = self._ctx_futures[deps] = concurrent.futures.Future()
+    if not starting:
+      # someone else is starting it
+      return future.result()
+    # started without the lock, so other contexts (and requests) don't wait on it
+    try:
+      pool = self._new_pool(deps)
+    except Exception as e:
+      with self._ctx_lock:
+        del self._ctx_futures[deps]
+      future.set_exception(e)
+      raise
+    evicted = []
     with self._ctx_lock:
-      port, child = self._ctxs.get(deps, (None, None))
-      if port: return port
-      port, child = self.build_js_context(deps)
-      self._ctxs[deps] = port, child
-      return port
+      del self._ctx_futures[deps]
+      self._ctxs[deps] = pool
+      while self.render_max_contexts and len(self._ctxs) > self.render_max_contexts:
+        evicted.append(self._ctxs.popitem(last=False))
+    future.set_result(pool)
+    for old_deps, old_pool in evicted:
+      if self.verbose: print('BR evicting render context', old_deps)
+      if self._metrics: self._metrics.count('context_evictions')
+      old_pool.close()
+    return pool
+
+  def _acquire_worker(self, deps):
+    '''
+      Returns (pool, worker) from the render context for deps.
+    '''
+    while True:
+      pool = self.get_js_context(deps)
+      try:
+        return pool, pool.acquire()
+      except _RenderPoolClosed:
+        # evicted or rebuilt since we got it, so there's a newer one
+        continue
+
+  def _new_pool(self, deps):
+    return _RenderPool(self, deps, self.render_pool_min, self.render_pool_max, self.render_pool_queue_depth, self.render_pool_idle_timeout)
+
+  def _get_shared_deps(self):
+    if self._shared_deps is None:
+      self._shared_deps = tuple(self._build_dep_list(self._jsx_files))
+    return self._shared_deps
     
+  def _socket_fn(self):
+    name = 'br_ctx_%i_%i.sock' % (os.getpid(), next(_ctx_counter))
+    sock_fn = os.path.join(self.socket_path, name)
+    if len(sock_fn.encode()) <= _MAX_SOCKET_PATH:
+      if not os.path.isdir(self.socket_path):
+        os.makedirs(self.socket_path)
+      return sock_fn
+    # unix socket paths are limited to ~100 bytes, so long work_paths get a short temp dir
+    if self._short_socket_path is None:
+      self._short_socket_path = tempfile.mkdtemp(prefix='br_')
+    sock_fn = os.path.join(self._short_socket_path, name)
+    if len(sock_fn.encode()) > _MAX_SOCKET_PATH:
+      raise Exception('Unix socket path %s is longer than %i bytes - please use a shorter work_path or TMPDIR.' % (repr(sock_fn), _MAX_SOCKET_PATH))
+    return sock_fn
+
   def build_js_context(self, deps):
-    port = _get_free_tcp_port()
-    if self.verbose: print('BR building nodejs server http://localhost:%i'%port)
-    fd, nodejs_fn = tempfile.mkstemp(suffix='.js', prefix='br_ctx_p%i_'%port)
+    sock_fn = self._socket_fn()
+    if os.path.exists(sock_fn):
+      os.remove(sock_fn)
+    if self.verbose: print('BR building nodejs server unix:%s' % sock_fn)
+    ready_r, ready_w = os.pipe()
+    fd, nodejs_fn = tempfile.mkstemp(suffix='.js', prefix='br_ctx_')
     os.close(fd)
-    if not self.prod:
-      transformer = react.jsx.JSXTransformer()
     with open(nodejs_fn,'w') as of:
       of.write(FAKE_BROWSER_JS)
       for dep in deps:
@@ -320,12 +805,9 @@ class BottleReact(object):
               of.write(f.read())
           else:
             js_path = os.path.join(self.jsx_path, dep)
-            with tempfile.NamedTemporaryFile(suffix='.js') as f:
-              transformer.transform(js_path, js_path=f.name, harmony=self.harmony)
-              with open(f.name) as f2:
-                print('adding ', f.name, 'from', js_path)
-                of.write('\n\n// BR importing: %s\n\n' % f.name)
-                of.write(f2.read())
+            print('adding ', js_path)
+            of.write('\n\n// BR importing: %s\n\n' % js_path)
+            of.write(self._transpile(dep))
 
       of.write('''
         var ReactDOMServer;
@@ -334,17 +816,40 @@ class BottleReact(object):
         }else{
           ReactDOMServer = __br_original_require('react-dom/server')
         }
+
+        // nodes arrive as [class_name, props, children], see _ReactNode.to_render_tree()
+        var _br_build = function(node) {
+          if (typeof node === 'string') return node;
+          var cls = bottlereact[node[0]];
+          if (typeof cls === 'undefined') throw new Error('BR unknown react class: '+ node[0]);
+          return React.createElement(cls, node[1], node[2].map(_br_build));
+        };
         
-        _br_http.createServer((request, response) => { 
+        var server = _br_http.createServer((request, response) => { 
           var body = [];
           request.on('error', function(err) {
             console.error('BR nodejs error:', err);
           }).on('data', function(chunk) {
             body.push(chunk);
           }).on('end', function() {
+            if (request.url === '/ping') {
+              response.writeHead(200);
+              response.end('pong');
+              return;
+            }
             try {
               body = Buffer.concat(body).toString();
-              var react_node = eval(body);
+              var react_node = _br_build(JSON.parse(body));
+              if (request.url === '/stream' && ReactDOMServer.renderToNodeStream) {
+                response.writeHead(200);
+                var stream = ReactDOMServer.renderToNodeStream(react_node);
+                stream.on('error', function(err) {
+                  console.log(err);
+                  response.destroy(err);
+                });
+                stream.pipe(response);
+                return;
+              }
               var ret = ReactDOMServer.renderToString(react_node);
               response.writeHead(200);
               response.end(ret);
@@ -354,85 +859,581 @@ class BottleReact(object):
               response.end(String(err) +'\\n\\n'+ err.stack);
             }
           });
-        }).listen(%i, 'localhost', (err) => {  
-          if (err) {
-            return console.log('something bad happened', err)
-          }
-          console.log(`BR nodejs server is listening on http://localhost:%i`)
+        });
+        server.keepAliveTimeout = 0; // the python side holds persistent connections
+        server.on('error', (err) => {
+          console.log('BR nodejs server error', err);
+          process.exit(1);
+        });
+        server.listen(%s, () => {
+          console.log('BR nodejs server is listening on unix:'+ %s);
+          // tell python we're ready to take requests
+          var fs = __br_original_require('fs');
+          fs.writeSync(%i, 'ready\\n');
+          fs.closeSync(%i);
         })
-      ''' % (port,port))
+      ''' % (json.dumps(sock_fn), json.dumps(sock_fn), ready_w, ready_w))
 
     env = os.environ.copy()
     env["NODE_PATH"] = self._NODE_PATH
-    child = subprocess.Popen(['node', nodejs_fn], env=env, preexec_fn = set_pdeathsig(signal.SIGTERM))
-    def delete_nodejs_fn():
-      os.remove(nodejs_fn)
-    if self.prod:
-      threading.Timer(2, delete_nodejs_fn).start()
-    return port, child
-  
-  def render_server(self, deps, react_js, retry=True):
+    try:
+      child = _popen(['node', nodejs_fn], env=env, preexec_fn = set_pdeathsig(signal.SIGTERM), pass_fds=(ready_w,))
+    finally:
+      os.close(ready_w)
+    try:
+      _wait_for_ready(child, ready_r, self.render_start_timeout)
+    except:
+      child.kill()
+      raise
+    finally:
+      os.close(ready_r)
+      if self.prod:
+        os.remove(nodejs_fn)
+    return sock_fn, child
+
+  def prewarm(self, roots=None):
+    '''
+      Starts (and waits for) the render servers for the given root components
+      (class names, br.Xyz classes or br.Xyz() nodes).  If None, that's the
+      shared context with render_shared_context, else every jsx file no other
+      jsx file requires (each a page on its own, presumably).
+    '''
     self._init_render_server()
+    if self.render_shared_context:
+      files = [self._jsx_files]
+    elif roots is None:
+      required = set(dep for fn in self._jsx_files for dep in self._closure(fn)[:-1])
+      files = [[fn] for fn in self._jsx_files if fn not in required]
+    else:
+      files = []
+      for root in roots:
+        if isinstance(root, basestring):
+          root = getattr(self, root)
+        files.append(root.get_js_files() if isinstance(root, _ReactNode) else [root.fn])
+    all_deps = _dedup([tuple(self._build_dep_list(fns)) for fns in files])
+    if not all_deps: return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(all_deps), os.cpu_count() or 1)) as executor:
+      for pool in executor.map(self.get_js_context, all_deps):
+        pass
+  
+  def _render_cache_key(self, deps, react_tree):
+    return hashlib.sha256(('\n'.join(deps) +'\0'+ react_tree).encode()).digest()
+
+  def invalidate_render_cache(self, react_node=None):
+    '''
+      Drops the cached server side render of react_node, or everything if None.
+    '''
+    if self._render_cache is None: return
+    if react_node is None:
+      self._render_cache.clear()
+    else:
+      deps = self._build_dep_list(react_node.get_js_files())
+      self._render_cache.pop(self._render_cache_key(deps, react_node.to_render_json()))
+
+  def metrics(self):
+    '''
+      Snapshot of the counters, per phase timings (count, total seconds and
+      cumulative histogram buckets) and the live render servers (with their
+      RSS, where /proc has it).  Needs metrics=True (or metrics_path or
+      on_timing).
+    '''
+    if self._metrics is None:
+      raise Exception('BottleReact(metrics=True) is required for metrics()')
+    counters, timings = self._metrics.snapshot()
+    for name, cache in [('render_cache', self._render_cache), ('asset_cache', self._asset_cache), ('template_cache', self._templates)]:
+      if cache is not None:
+        counters[name +'_hits'] = cache.hits
+        counters[name +'_misses'] = cache.misses
+    with self._ctx_lock:
+      pools = list(self._ctxs.values())
+    workers = []
+    for pool in pools:
+      for worker in list(pool.workers):
+        pid = getattr(worker.child, 'pid', None)
+        workers.append({'address':worker.address, 'pid':pid, 'inflight':worker.inflight, 'rss_bytes':_rss(pid)})
+    return {
+      'counters': counters,
+      'timings': dict((phase, {'count':t[-2], 'seconds':t[-1], 'buckets':list(zip(_Metrics.BUCKETS, t))}) for phase, t in timings.items()),
+      'contexts': len(pools),
+      'workers': workers,
+    }
+
+  def metrics_text(self):
+    '''
+      metrics() in the Prometheus text format.
+    '''
+    m = self.metrics()
+    lines = []
+    for name, value in sorted(m['counters'].items()):
+      lines.append('# TYPE bottlereact_%s_total counter' % name)
+      lines.append('bottlereact_%s_total %i' % (name, value))
+    lines.append('# TYPE bottlereact_phase_seconds histogram')
+    for phase, t in sorted(m['timings'].items()):
+      for le, n in t['buckets']:
+        lines.append('bottlereact_phase_seconds_bucket{phase="%s",le="%s"} %i' % (phase, le, n))
+      lines.append('bottlereact_phase_seconds_bucket{phase="%s",le="+Inf"} %i' % (phase, t['count']))
+      lines.append('bottlereact_phase_seconds_sum{phase="%s"} %r' % (phase, t['seconds']))
+      lines.append('bottlereact_phase_seconds_count{phase="%s"} %i' % (phase, t['count']))
+    lines.append('# TYPE bottlereact_contexts gauge')
+    lines.append('bottlereact_contexts %i' % m['contexts'])
+    lines.append('# TYPE bottlereact_workers gauge')
+    lines.append('bottlereact_workers %i' % len(m['workers']))
+    lines.append('# TYPE bottlereact_workers_rss_bytes gauge')
+    lines.append('bottlereact_workers_rss_bytes %i' % sum(w['rss_bytes'] or 0 for w in m['workers']))
+    return '\n'.join(lines) + '\n'
+
+  def render_server(self, deps, react_tree, retry=True):
     deps = tuple(deps)
-    port = self.get_js_context(deps)
+    if self._render_cache is not None:
+      key = self._render_cache_key(deps, react_tree)
+      ret = self._render_cache.get(key)
+      if ret is None:
+        ret = self._render_server_uncached(deps, react_tree, retry=retry)
+        self._render_cache.put(key, ret)
+      return ret
+    return self._render_server_uncached(deps, react_tree, retry=retry)
+
+  def _render_server_uncached(self, deps, react_tree, retry=True):
+    self._init_render_server()
+    pool, worker = self._acquire_worker(deps)
+    start = time.perf_counter()
     try:
-      for i in range(10):
-        try:
-          with urlopen('http://localhost:%i' % port, react_js.encode()) as f:
-            ret = f.read()
-          return ret
-        except urllib.error.URLError as e:
-          if isinstance(e.reason, ConnectionRefusedError):
-            time.sleep(.5)
-            continue
-          else:
-            raise Exception(e.file.read().decode())
+      ret = worker.request(react_tree.encode())
+      if self._metrics: self._metrics.timing('render_server', time.perf_counter() - start)
+      return ret
     except Exception as e:
-      with self._ctx_lock:
-        if self.verbose: print('BR nodejs server at http://localhost:%i is non-responsive - killing' % port)
-        try:
-          port, child = self._ctxs.pop(deps)
-          child.terminate()
-          child.kill()
-        except KeyError: pass
-        print(e)
+      if self.verbose: print('BR nodejs server at unix:%s is non-responsive - killing' % worker.address)
+      pool.remove(worker)
+      print(e)
+      if self._metrics: self._metrics.count('render_failures')
       if retry:
-        return self.render_server(deps, react_js, retry=False)
+        if self._metrics: self._metrics.count('render_retries')
+        return self._render_server_uncached(deps, react_tree, retry=False)
       else:
         raise e
+    finally:
+      pool.release(worker)
     
 
+  async def render_server_async(self, deps, react_tree, retry=True):
+    deps = tuple(deps)
+    if self._render_cache is not None:
+      key = self._render_cache_key(deps, react_tree)
+      ret = self._render_cache.get(key)
+      if ret is None:
+        ret = await self._render_server_uncached_async(deps, react_tree, retry=retry)
+        self._render_cache.put(key, ret)
+      return ret
+    return await self._render_server_uncached_async(deps, react_tree, retry=retry)
+
+  async def _render_server_uncached_async(self, deps, react_tree, retry=True):
+    loop = asyncio.get_event_loop()
+    # anything that might start node runs in an executor, not on the event loop
+    if not self._inited_render_server:
+      await loop.run_in_executor(None, self._init_render_server)
+    pool = self._ctxs.get(deps)
+    if pool is None or self.render_shared_context or self.render_max_contexts or len(pool.workers) < pool.min_size:
+      pool, worker = await loop.run_in_executor(None, self._acquire_worker, deps)
+    else:
+      try:
+        worker = pool.acquire()
+      except _RenderPoolClosed:
+        pool, worker = await loop.run_in_executor(None, self._acquire_worker, deps)
+    start = time.perf_counter()
+    try:
+      ret = await worker.request_async(react_tree.encode())
+      if self._metrics: self._metrics.timing('render_server', time.perf_counter() - start)
+      return ret
+    except Exception as e:
+      if self.verbose: print('BR nodejs server at unix:%s is non-responsive - killing' % worker.address)
+      pool.remove(worker)
+      print(e)
+      if self._metrics: self._metrics.count('render_failures')
+      if retry:
+        if self._metrics: self._metrics.count('render_retries')
+        return await self._render_server_uncached_async(deps, react_tree, retry=False)
+      else:
+        raise e
+    finally:
+      pool.release(worker)
+
+  def render_server_stream(self, deps, react_tree, retry=True):
+    '''
+      Generator version of render_server, yielding the html as nodejs renders it.
+    '''
+    deps = tuple(deps)
+    if self._render_cache is not None:
+      key = self._render_cache_key(deps, react_tree)
+      ret = self._render_cache.get(key)
+      if ret is not None:
+        yield ret
+        return
+      chunks = []
+      for chunk in self._render_server_stream_uncached(deps, react_tree, retry=retry):
+        chunks.append(chunk)
+        yield chunk
+      self._render_cache.put(key, b''.join(chunks))
+      return
+    for chunk in self._render_server_stream_uncached(deps, react_tree, retry=retry):
+      yield chunk
+
+  def _render_server_stream_uncached(self, deps, react_tree, retry=True):
+    self._init_render_server()
+    pool, worker = self._acquire_worker(deps)
+    started = False
+    start = time.perf_counter()
+    try:
+      for chunk in worker.request_stream(react_tree.encode()):
+        started = True
+        yield chunk
+      # includes time the consumer spent between chunks
+      if self._metrics: self._metrics.timing('render_server_stream', time.perf_counter() - start)
+    except Exception as e:
+      if self.verbose: print('BR nodejs server at unix:%s is non-responsive - killing' % worker.address)
+      pool.remove(worker)
+      print(e)
+      if self._metrics: self._metrics.count('render_failures')
+      # once part of the body is out there's no starting over
+      if retry and not started:
+        if self._metrics: self._metrics.count('render_retries')
+        for chunk in self._render_server_stream_uncached(deps, react_tree, retry=False):
+          yield chunk
+      else:
+        raise e
+    finally:
+      pool.release(worker)
+
   def render_html(self, react_node, **kwargs):
-    kwargs = self.calc_render_html_kwargs(kwargs)
-    template = kwargs.get('template', 'bottlereact')
-    render_server = kwargs.get('render_server', self._render_server)
-    react_js = react_node.to_javascript()
-    deps = self._build_dep_list(react_node.get_js_files())
-    classes = _make_json_string_browser_safe(json.dumps(list(react_node.get_react_classes())))
-    deps_html = ['']
+    template, kwargs, deps, render_server = self._prepare_render_html(react_node, kwargs)
+    if kwargs.get('stream'):
+      react_tree = react_node.to_render_json() if render_server else None
+      return self._render_html_stream(template, kwargs, deps, react_tree)
+    if render_server:
+      kwargs['body'] = self.render_server(deps, react_node.to_render_json())
+    return self._render_template(template, kwargs)
+
+  def _render_html_stream(self, template, kwargs, deps, react_tree):
+    if react_tree is None:
+      # nothing to wait on, so the template gets its usual (empty) body
+      yield self._render_template(template, kwargs)
+      return
+    # everything before the body (including deps) goes out before nodejs is asked for anything
+    kwargs['body'] = _BODY_MARKER
+    head, marker, tail = self._render_template(template, kwargs).partition(_BODY_MARKER)
+    yield head
+    if marker:
+      decoder = codecs.getincrementaldecoder('utf8')()
+      for chunk in self.render_server_stream(deps, react_tree):
+        chunk = decoder.decode(chunk)
+        if chunk: yield chunk
+    yield tail
+
+  async def render_html_async(self, react_node, **kwargs):
+    '''
+      Same as render_html, but server side rendering doesn't block the event loop.
+    '''
+    template, kwargs, deps, render_server = self._prepare_render_html(react_node, kwargs)
+    if render_server:
+      kwargs['body'] = await self.render_server_async(deps, react_node.to_render_json())
+    return self._render_template(template, kwargs)
+
+  def _render_template(self, template, kwargs):
+    if self._metrics is None:
+      return self._render_template_untimed(template, kwargs)
+    start = time.perf_counter()
+    ret = self._render_template_untimed(template, kwargs)
+    self._metrics.timing('template', time.perf_counter() - start)
+    return ret
+
+  def _render_template_untimed(self, template, kwargs):
+    if self._templates is None:
+      return bottle.template(template, **kwargs)
+    nonce = kwargs.get('init_nonce')
+    try:
+      key = (template, bool(kwargs['body']), bool(nonce), frozenset((k, v) for k, v in kwargs.items() if k not in _TEMPLATE_SLOTS))
+      parts = self._templates.get(key)
+    except TypeError: # unhashable kwargs
+      return bottle.template(template, **kwargs)
+    if parts is None:
+      html = bottle.template(template, **kwargs)
+      # only keys seen before are compiled, so one-off kwargs (a per request
+      # title, say) don't pay for compiling
+      if self._templates_seen.get(key) is None:
+        self._templates_seen.put(key, '')
+      else:
+        self._templates_seen.pop(key)
+        self._templates.put(key, self._compile_template(template, kwargs, html))
+      return html
+    if not parts:
+      return bottle.template(template, **kwargs)
+    parts = list(parts)
+    for i in range(1, len(parts), 2):
+      parts[i] = bottle.touni(kwargs[parts[i]])
+    return ''.join(parts)
+
+  def _compile_template(self, template, kwargs, html):
+    '''
+      Splits template (rendered with everything but the slots) into static
+      segments and slot names, alternating.  Returns () if putting kwargs back
+      into the slots doesn't give html, say because the template escapes or
+      tests them.
+    '''
+    token = os.urandom(8).hex()
+    markers = {}
+    sentinel_kwargs = dict(kwargs)
+    for slot in _TEMPLATE_SLOTS:
+      if not kwargs.get(slot): continue
+      # the token on both ends keeps 'init' from being a prefix of 'init_nonce', and
+      # <"&' change if escaped, so an escaping template fails the check below
+      marker = '<brslot"&\'%s%s%s>' % (token, slot, token)
+      markers[marker] = slot
+      sentinel_kwargs[slot] = marker
+    parts = bottle.template(template, **sentinel_kwargs)
+    parts = re.split('(%s)' % '|'.join(map(re.escape, markers)), parts) if markers else [parts]
+    for i in range(1, len(parts), 2):
+      parts[i] = markers[parts[i]]
+    parts = tuple(parts)
+    if ''.join(bottle.touni(kwargs[p]) if i % 2 else p for i, p in enumerate(parts)) != html:
+      if self.verbose: print('BR could not compile template', repr(template))
+      return ()
+    return parts
+
+  def _converted_fn(self, jsx_hashed_fn):
+    # minified output gets its own name, so turning minify on or off never reuses the other's files
+    return jsx_hashed_fn[:-4] + ('.min.js' if self.minify else '.js')
+
+  def _precompress_file(self, fn):
+    '''
+      Writes .gz (and .br, if the brotli package is installed) siblings of a
+      text asset in hashed_path, if they're smaller.  Ones that aren't are
+      noted in the manifest (hashed files never change), so they're not tried
+      again.
+    '''
+    if os.path.splitext(fn)[1] not in _COMPRESSIBLE: return
+    variants = [('.gz', lambda data: gzip.compress(data, 9, mtime=0))]
+    if BROTLI_AROUND:
+      variants.append(('.br', brotli.compress))
+    entry = self._manifest.get(fn)
+    incompressible = entry.get('incompressible', []) if isinstance(entry, dict) else []
+    data = None
+    for ext, compress in variants:
+      if ext in incompressible or os.path.exists(fn + ext): continue
+      if data is None:
+        with open(fn, 'rb') as f:
+          data = f.read()
+      compressed = compress(data)
+      if len(compressed) < len(data):
+        _atomic_write(fn + ext, compressed)
+      else:
+        incompressible.append(ext)
+        self._manifest[fn] = {'incompressible': incompressible}
+
+  def _precompressed_variant(self, path, accept_encoding):
+    '''
+      Returns (filename, content encoding) of the best precompressed variant
+      of path the client accepts, or (path, None).
+    '''
+    if not self.precompress or os.path.splitext(path)[1] not in _COMPRESSIBLE: return path, None
+    accepted = _parse_accept_encoding(accept_encoding)
+    for encoding, ext in [('br', '.br'), ('gzip', '.gz')]:
+      if encoding in accepted and os.path.isfile(os.path.join(self.hashed_path, path + ext)):
+        return path + ext, encoding
+    return path, None
+
+  def _preload_asset_cache(self):
+    for hashed_fn in sorted(set(self._fn2hash.values())):
+      for fn in [hashed_fn, hashed_fn+'.br', hashed_fn+'.gz']:
+        path = os.path.join(self.hashed_path, fn)
+        if not os.path.isfile(path): continue
+        if self._asset_cache.bytes + os.path.getsize(path) > self._asset_cache.max_bytes: continue
+        with open(path, 'rb') as f:
+          self._asset_cache.put(fn, f.read())
+
+  def _serve_cached_asset(self, path, fn, encoding, if_none_match):
+    '''
+      Returns (status, headers, body) for a hashed asset from the in-memory
+      cache (loading it if it fits), or None if it should be served from disk.
+    '''
+    if self._asset_cache is None or '/' in fn or fn.startswith('.'): return None
+    data = self._asset_cache.get(fn)
+    if data is None:
+      path_fn = os.path.join(self.hashed_path, fn)
+      if not os.path.isfile(path_fn) or os.path.getsize(path_fn) > self._asset_cache.max_bytes: return None
+      with open(path_fn, 'rb') as f:
+        data = f.read()
+      self._asset_cache.put(fn, data)
+    # hashed file names start with the hash of their content
+    etag = '"%s%s"' % (fn.split('-', 1)[0], fn[len(path):])
+    headers = {
+      'ETag': etag,
+      'Cache-Control': 'public, max-age=31536000', # one year
+    }
+    if self.precompress:
+      headers['Vary'] = 'Accept-Encoding'
+    if if_none_match and (if_none_match.strip()=='*' or etag in [t.strip() for t in if_none_match.split(',')]):
+      return 304, headers, b''
+    mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    if mimetype.startswith('text/') or mimetype=='application/javascript':
+      mimetype += '; charset=UTF-8'
+    headers['Content-Type'] = mimetype
+    headers['Content-Length'] = str(len(data))
+    if encoding:
+      headers['Content-Encoding'] = encoding
+    return 200, headers, data
+
+  def _bundle_deps(self, deps):
+    '''
+      Replaces the local files in deps with (up to) one vendor and one page
+      bundle each for css and js, written to hashed_path.
+    '''
+    deps = tuple(deps)
+    ret = self._bundles.get(deps)
+    if ret is not None: return ret
+    ret = []
+    groups = collections.defaultdict(list)
     for dep in deps:
+      fn = _make_string_fn_safe(dep) if dep.startswith('http://') or dep.startswith('https://') else dep
+      if fn not in self._fn2hash:
+        ret.append(dep) # not downloaded, can't be bundled
+        continue
+      ext = '.css' if fn.endswith('.css') else '.js'
+      groups[(ext, dep not in self.bundle_vendor)].append(fn)
+    for key in [('.css', False), ('.css', True), ('.js', False), ('.js', True)]:
+      if groups[key]:
+        ret.append(self._write_bundle(groups[key], key[0]))
+    self._bundles[deps] = ret
+    return ret
+
+  def _write_bundle(self, fns, ext):
+    contents = []
+    for fn in fns:
+      with open(os.path.join(self.hashed_path, self._fn2hash[fn]), 'rb') as f:
+        contents.append(f.read())
+    data = (b'\n' if ext=='.css' else b'\n;\n').join(contents)
+    hashed_fn = '%s-bundle%s' % (hashlib.sha256(data).hexdigest()[:16], ext)
+    if not os.path.exists(os.path.join(self.hashed_path, hashed_fn)):
+      _atomic_write(os.path.join(self.hashed_path, hashed_fn), data)
+      if self.precompress:
+        self._precompress_file(os.path.join(self.hashed_path, hashed_fn))
+    if self.verbose: print('BR bundled', fns, 'into', hashed_fn)
+    return hashed_fn
+
+  def _deps_html(self, deps, preload=False, inline_under=None, script_loading=None, nonce=''):
+    # the nonce only matters for inlined assets, and (usually being random)
+    # isn't worth memoizing
+    key = (tuple(deps), bool(preload), inline_under, script_loading)
+    ret = self._deps_html_memo.get(key) if not (inline_under and nonce) else None
+    if ret is None:
+      ret = self._build_deps_html(deps, preload, inline_under, script_loading, nonce)
+      if not (inline_under and nonce): self._deps_html_memo[key] = ret
+    deps_html, link = ret
+    if link: self._add_link_header(link)
+    return deps_html
+
+  def _build_deps_html(self, deps, preload, inline_under, script_loading, nonce):
+    deps_html = ['']
+    preloads = []
+    defer = ' defer' if script_loading == 'defer' else ''
+    for dep in (self._bundle_deps(deps) if self.bundle else deps):
       path = dep if dep.startswith('http://') or dep.startswith('https://') else self.get_asset_path(dep)
+      # inline scripts can't be deferred, and would run before the deferred ones they need
+      if inline_under and self.prod and not (defer and not path.endswith('.css')):
+        content = self._inline_content(dep, inline_under)
+        if content is not None:
+          if path.endswith('.css'):
+            deps_html.append('<style%s>%s</style>' % (nonce, content.replace('</style', '<\\/style')))
+          else:
+            deps_html.append('<script%s>%s</script>' % (nonce, content.replace('</script', '<\\/script')))
+          continue
       if path.endswith('.css'):
+        preloads.append((path, 'style'))
         deps_html.append('<link href="%s" rel="stylesheet">' % bottle.html_escape(path))
       elif path.endswith('.js'):
-        deps_html.append('<script src="%s"></script>' % bottle.html_escape(path))
-      elif path.endswith('.jsx'):
+        preloads.append((path, 'script'))
+        deps_html.append('<script src="%s"%s></script>' % (bottle.html_escape(path), defer))
+      elif path.endswith('.jsx') and not self.dev_transpile:
         deps_html.append('<script type="text/babel" src="%s"></script>' % bottle.html_escape(path))
       else: # assume javascript
-        deps_html.append('<script src="%s"></script>' % bottle.html_escape(path))
-    deps_html = '\n'.join(deps_html)
+        preloads.append((path, 'script'))
+        deps_html.append('<script src="%s"%s></script>' % (bottle.html_escape(path), defer))
+    link = None
+    if preload and preloads:
+      deps_html[1:1] = ['<link rel="preload" href="%s" as="%s">' % (bottle.html_escape(path), kind) for path, kind in preloads]
+      link = ', '.join('<%s>; rel=preload; as=%s' % (path, kind) for path, kind in preloads)
+    return '\n'.join(deps_html), link
+
+  def _inline_content(self, dep, max_size):
+    '''
+      Contents of a hashed asset if it's smaller than max_size bytes, else None.
+    '''
+    if dep.startswith('http://') or dep.startswith('https://'):
+      dep = _make_string_fn_safe(dep)
+    fn = os.path.join(self.hashed_path, self._fn2hash.get(dep, dep))
+    key = (fn, max_size)
+    if key not in self._inline_cache:
+      content = None
+      if os.path.isfile(fn) and os.path.getsize(fn) < max_size:
+        with open(fn) as f:
+          content = f.read()
+      self._inline_cache[key] = content
+    return self._inline_cache[key]
+
+  def _add_link_header(self, value):
+    if FLASK_AROUND and isinstance(self.app, flask.app.Flask):
+      if not flask.has_request_context(): return
+      @flask.after_this_request
+      def add_link_header(response):
+        response.headers.add('Link', value)
+        return response
+    else:
+      bottle.response.add_header('Link', value)
+
+  def _prepare_render_html(self, react_node, kwargs):
+    kwargs = self.calc_render_html_kwargs(kwargs)
+    template = kwargs.get('template', 'bottlereact')
+    render_server = kwargs.get('render_server', self._render_server)
+    hoist_props = kwargs.get('hoist_props', False)
+    hoisted = {} if hoist_props else None
+    hoist_min_size = _HOIST_MIN_SIZE if hoist_props is True else hoist_props
+    start = time.perf_counter()
+    files, classes, react_js = react_node._render_plan(hoisted, hoist_min_size)
+    if self._metrics:
+      now = time.perf_counter()
+      self._metrics.timing('serialize', now - start)
+      start = now
+    deps = self._build_dep_list(files)
+    classes_json = self._classes_json.get(classes)
+    if classes_json is None:
+      classes_json = self._classes_json[classes] = _make_json_string_browser_safe(json.dumps(sorted(classes)))
     init_nonce = kwargs.get('init_nonce', None)
     init_nonce = ' nonce="%s"' % init_nonce if init_nonce else ''
-    init = '''
-    <script%s>
-      bottlereact._onLoad(%s, function() {
+    script_loading = kwargs.get('script_loading')
+    if script_loading not in (None, 'defer'):
+      raise Exception('script_loading must be None or "defer", not %s' % repr(script_loading))
+    deps_html = self._deps_html(deps, kwargs.get('preload', False), kwargs.get('inline_assets_under'), script_loading, init_nonce)
+    if self._metrics: self._metrics.timing('deps', time.perf_counter() - start)
+    init_js = '''bottlereact._onLoad(%s, function() {
         ReactDOM.render(
           %s,
           document.getElementById('__body__')
         );
-      });
+      });''' % (classes_json, react_js)
+    if hoisted:
+      # parsed once, referenced by the createElement calls
+      init_js = '''(function() {
+      var __br_p = JSON.parse(document.getElementById('__br_props__').textContent);
+      %s
+      })();''' % init_js
+    if script_loading == 'defer':
+      # deferred scripts run just before DOMContentLoaded
+      init_js = '''document.addEventListener('DOMContentLoaded', function() {
+      %s
+      });''' % init_js
+    init = '''
+    %s<script%s>
+      %s
     </script>
-    ''' % (init_nonce, classes, react_js)
+    ''' % (_hoisted_props_html(hoisted) if hoisted else '', init_nonce, init_js)
     if 'title' not in kwargs: kwargs['title'] = 'bottle-react - https://github.com/keredson/bottle-react'
     kwargs.update({
       'deps': deps_html,
@@ -443,23 +1444,142 @@ class BottleReact(object):
     })
     if callable(render_server):
       render_server = render_server()
-    if render_server:
-      kwargs['body'] = self.render_server(deps, react_js)
-    return bottle.template(template, **kwargs)
+    return template, kwargs, deps, render_server
+
+
+_BODY_MARKER = '<!--__br_body__-->'
+_TEMPLATE_SLOTS = ('deps', 'init', 'body', 'init_nonce')
+_PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
 
+_json_encode = json.JSONEncoder().encode
+
+if ORJSON_AROUND:
+  def _json_dumps(o):
+    try:
+      return orjson.dumps(o).decode()
+    except TypeError: # non-string keys, etc.
+      return _json_encode(o)
+else:
+  _json_dumps = _json_encode
+
+_COMPRESSIBLE = set(['.js', '.css', '.html', '.json', '.map', '.svg', '.txt', '.xml'])
+
+def _parse_accept_encoding(header):
+  ret = set()
+  for part in header.split(','):
+    params = part.strip().split(';')
+    encoding = params[0].strip().lower()
+    q = 1.0
+    for param in params[1:]:
+      k, _, v = param.strip().partition('=')
+      if k.strip()=='q':
+        try:
+          q = float(v)
+        except ValueError:
+          q = 0
+    if encoding and q > 0:
+      ret.add(encoding)
+  return ret
 
 def _make_json_string_browser_safe(s):
   return s.replace('</', '<\\/')
   
+_HOIST_MIN_SIZE = 32
+
+def _hoisted_props_js(props, hoisted, min_size):
+  parts = []
+  for k, v in props.items():
+    v = _json_dumps(v)
+    if len(v) >= min_size:
+      v = '__br_p[%i]' % hoisted.setdefault(v, len(hoisted))
+    parts.append('%s:%s' % (_json_dumps(str(k)), v))
+  return '{%s}' % ','.join(parts)
+
+def _hoisted_props_html(hoisted):
+  # '<' only appears inside JSON strings, where \u003c is the same character
+  blob = '[%s]' % ','.join(hoisted)
+  return '<script type="application/json" id="__br_props__">%s</script>' % blob.replace('<', '\\u003c')
+
 def _make_string_fn_safe(s):
   return "".join([c if re.match(r'[\w.]', c) else '_' for c in s])
 
-def _get_free_tcp_port():
-  tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-  tcp.bind(('localhost', 0))
-  addr, port = tcp.getsockname()
-  tcp.close()
-  return port
+_ctx_counter = itertools.count()
+
+def _wait_for_ready(child, fd, timeout):
+  deadline = time.time() + timeout
+  data = b''
+  while not data.endswith(b'\n'):
+    remaining = deadline - time.time()
+    if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+      raise Exception('BR nodejs server did not start within %is' % timeout)
+    chunk = os.read(fd, 64)
+    if not chunk:
+      raise Exception('BR nodejs server exited during startup (exit code %s)' % child.wait())
+    data += chunk
+
+def _scan_jsx_file(path):
+  '''
+    Returns ([react class names], [requirements]) defined in a jsx file.
+  '''
+  classes = []
+  reqs = []
+  with open(path, 'r') as f:
+    for line in f:
+      if 'React.createClass' in line:
+        if '=' not in line: continue
+        classes.append(line.split('=')[0].strip().split()[-1])
+      if 'createReactClass' in line:
+        if '=' not in line: continue
+        classes.append(line.split('=')[0].strip().split()[-1])
+      if 'extends React.Component' in line:
+        if 'class' not in line: continue
+        classes.append(line[line.find('class')+5:line.find('extends')].strip())
+      if line.startswith('// require '):
+        reqs.append(line[len('// require '):].strip())
+  return classes, reqs
+
+_transformer = None
+
+def _transform_jsx(src, dest, harmony, minify=False):
+  # run in the build worker processes, so returns the error instead of raising it
+  global _transformer
+  try:
+    if _transformer is None:
+      _transformer = react.jsx.JSXTransformer()
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(dest), prefix='.tmp-')
+    os.close(fd)
+    try:
+      _transformer.transform(src, js_path=tmp_fn, harmony=harmony)
+      if minify:
+        with open(tmp_fn) as f:
+          js = rjsmin.jsmin(f.read())
+        with open(tmp_fn, 'w') as f:
+          f.write(js)
+      os.chmod(tmp_fn, 0o644) # mkstemp makes it private
+      os.rename(tmp_fn, dest)
+    except:
+      os.remove(tmp_fn)
+      raise
+  except Exception as e:
+    return str(e) or repr(e)
+
+def _sha256_file(fn):
+  h = hashlib.sha256()
+  with open(fn, 'rb') as f:
+    for block in iter(lambda: f.read(1<<16), b''):
+      h.update(block)
+  return h.hexdigest()
+
+def _atomic_write(fn, data):
+  fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix='.tmp-')
+  try:
+    with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+      f.write(data)
+    os.chmod(tmp_fn, 0o644) # mkstemp makes it private
+    os.rename(tmp_fn, fn)
+  except:
+    os.remove(tmp_fn)
+    raise
 
 def _dedup(seq):
   seen = set()
@@ -467,53 +1587,632 @@ def _dedup(seq):
   return [x for x in seq if not (x in seen or seen_add(x))]
 
 
+class _UnixHTTPConnection(httplib.HTTPConnection):
+  def __init__(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+    httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+    self.address = address
+
+  def connect(self):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+      sock.settimeout(self.timeout)
+    try:
+      sock.connect(self.address)
+    except:
+      sock.close()
+      raise
+    self.sock = sock
+
+
+async def _async_http_post(reader, writer, body):
+  '''
+    Minimal HTTP/1.1 client for the nodejs render server.
+    Returns (status, body, will_close).
+  '''
+  writer.write(b'POST / HTTP/1.1\r\nHost: localhost\r\nContent-Length: %i\r\n\r\n' % len(body))
+  writer.write(body)
+  await writer.drain()
+  line = await reader.readline()
+  if not line: raise EOFError()
+  status = int(line.split()[1])
+  headers = {}
+  while True:
+    line = await reader.readline()
+    if not line: raise EOFError()
+    if line in (b'\r\n', b'\n'): break
+    k, v = line.decode('latin-1').split(':', 1)
+    headers[k.strip().lower()] = v.strip()
+  if headers.get('transfer-encoding', '').lower() == 'chunked':
+    chunks = []
+    while True:
+      size = int((await reader.readline()).split(b';')[0], 16)
+      chunk = await reader.readexactly(size + 2)
+      if not size: break
+      chunks.append(chunk[:-2])
+    ret = b''.join(chunks)
+  elif 'content-length' in headers:
+    ret = await reader.readexactly(int(headers['content-length']))
+  else:
+    ret = await reader.read()
+    headers['connection'] = 'close'
+  return status, ret, headers.get('connection', '').lower() == 'close'
+
+
+class _RenderWorker(object):
+  def __init__(self, address, child, metrics=None, timeout=None):
+    self.address = address
+    self.child = child
+    self.timeout = timeout # seconds to wait on nodejs, per request
+    self._metrics = metrics
+    self._killed = False
+    self.renders = 0
+    self.draining = False # replaced, and stopped once idle
+    self.last_used = time.monotonic()
+    self.inflight = 0
+    self._conns = []
+    self._async_conns = {} # event loop -> [(reader, writer)]
+    self._conns_lock = threading.Lock()
+
+  def _get_conn(self):
+    with self._conns_lock:
+      if self._conns: return self._conns.pop(), True
+    return _UnixHTTPConnection(self.address, self.timeout or socket._GLOBAL_DEFAULT_TIMEOUT), False
+
+  def _put_conn(self, conn):
+    with self._conns_lock:
+      self._conns.append(conn)
+
+  def request(self, body):
+    while True:
+      conn, reused = self._get_conn()
+      try:
+        conn.request('POST', '/', body)
+        resp = conn.getresponse()
+        ret = resp.read()
+      except socket.timeout:
+        conn.close()
+        raise
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if reused: continue # node closed an idle keep-alive connection, try a fresh one
+        raise
+      if resp.will_close:
+        conn.close()
+      else:
+        self._put_conn(conn)
+      if resp.status != 200:
+        raise Exception(ret.decode())
+      return ret
+
+  def request_stream(self, body):
+    while True:
+      conn, reused = self._get_conn()
+      try:
+        conn.request('POST', '/stream', body)
+        resp = conn.getresponse()
+      except socket.timeout:
+        conn.close()
+        raise
+      except (httplib.HTTPException, socket.error):
+        conn.close()
+        if reused: continue # node closed an idle keep-alive connection, try a fresh one
+        raise
+      break
+    if resp.status != 200:
+      ret = resp.read()
+      conn.close()
+      raise Exception(ret.decode())
+    done = False
+    try:
+      while True:
+        chunk = resp.read1(65536)
+        if not chunk: break
+        yield chunk
+      # read1() doesn't mark a Content-Length response finished, read() does
+      resp.read()
+      done = True
+    finally:
+      # a half read response can't be reused
+      if done and not resp.will_close:
+        self._put_conn(conn)
+      else:
+        conn.close()
+
+  async def request_async(self, body):
+    # idle connections are tied to the event loop that opened them
+    loop = asyncio.get_event_loop()
+    while True:
+      with self._conns_lock:
+        conns = self._async_conns.get(loop)
+        stream = conns.pop() if conns else None
+      reused = stream is not None
+      if not reused:
+        stream = await asyncio.open_unix_connection(self.address)
+      reader, writer = stream
+      try:
+        status, ret, will_close = await asyncio.wait_for(_async_http_post(reader, writer, body), self.timeout)
+      except asyncio.TimeoutError:
+        writer.close()
+        raise
+      except (EOFError, asyncio.IncompleteReadError, httplib.HTTPException, socket.error):
+        writer.close()
+        if reused: continue # node closed an idle keep-alive connection, try a fresh one
+        raise
+      if will_close:
+        writer.close()
+      else:
+        with self._conns_lock:
+          for old_loop in [l for l in self._async_conns if l.is_closed()]:
+            del self._async_conns[old_loop]
+          self._async_conns.setdefault(loop, []).append(stream)
+      if status != 200:
+        raise Exception(ret.decode())
+      return ret
+
+  def ping(self, timeout):
+    '''
+      True if nodejs answers within timeout seconds.
+    '''
+    conn = _UnixHTTPConnection(self.address, timeout)
+    try:
+      conn.request('GET', '/ping')
+      resp = conn.getresponse()
+      resp.read()
+      return resp.status == 200
+    except (httplib.HTTPException, socket.error):
+      return False
+    finally:
+      conn.close()
+
+  def kill(self):
+    if self._metrics and not self._killed: self._metrics.count('context_kills')
+    self._killed = True
+    self.child.terminate()
+    self.child.kill()
+    with self._conns_lock:
+      conns, self._conns = self._conns, []
+      async_conns, self._async_conns = self._async_conns, {}
+    for conn in conns:
+      conn.close()
+    for loop, streams in async_conns.items():
+      if loop.is_closed(): continue
+      for reader, writer in streams:
+        loop.call_soon_threadsafe(writer.close)
+    try:
+      os.remove(self.address)
+    except OSError:
+      pass
+
+
+class _RenderPoolClosed(Exception):
+  pass
+
+
+class _RenderPool(object):
+  '''
+    A set of nodejs render servers sharing the same deps.  Requests go to the
+    least busy worker, and a new worker is started (up to max_size) whenever
+    every worker has queue_depth or more requests in flight.  Workers idle for
+    idle_timeout seconds are stopped again (down to min_size).
+  '''
+  def __init__(self, br, deps, min_size=1, max_size=1, queue_depth=1, idle_timeout=None):
+    self.br = br
+    self.deps = deps
+    self.min_size = min_size
+    self.max_size = max_size
+    self.queue_depth = queue_depth
+    self.idle_timeout = idle_timeout
+    self.workers = []
+    self.closed = False
+    self._spawning = 0
+    self._lock = threading.Lock()
+    self._spawned = threading.Condition(self._lock) # notified when a spawn finishes
+    for i in range(min_size):
+      self.workers.append(self._spawn())
+
+  def _spawn(self):
+    metrics = self.br._metrics
+    start = time.perf_counter()
+    try:
+      address, child = self.br.build_js_context(self.deps)
+    except Exception:
+      if metrics: metrics.count('context_spawn_failures')
+      raise
+    if metrics:
+      metrics.count('context_spawns')
+      metrics.timing('build_js_context', time.perf_counter() - start)
+    return _RenderWorker(address, child, metrics, self.br.render_timeout)
+
+  def _spawn_in_background(self):
+    def f():
+      try:
+        worker = self._spawn()
+      except Exception as e:
+        print('BR could not start nodejs server:', e)
+        worker = None
+      with self._lock:
+        self._spawning -= 1
+        if worker and self.closed:
+          worker.kill()
+        elif worker:
+          self.workers.append(worker)
+        self._spawned.notify_all()
+    threading.Thread(target=f, daemon=True).start()
+
+  def acquire(self):
+    with self._lock:
+      while True:
+        if self.closed:
+          raise _RenderPoolClosed('BR render context for %s was closed' % repr(self.deps))
+        if len(self.workers) + self._spawning < max(self.min_size, 1):
+          # replace dead workers synchronously, but without the lock, so
+          # requests to the live ones (and release()) don't wait on nodejs
+          self._spawning += 1
+          self._lock.release()
+          try:
+            worker = self._spawn()
+          finally:
+            self._lock.acquire()
+            self._spawning -= 1
+            self._spawned.notify_all()
+          if self.closed:
+            worker.kill()
+          else:
+            self.workers.append(worker)
+        elif not self.workers:
+          # someone else is starting one
+          self._spawned.wait()
+        else:
+          break
+      worker = min(self.workers, key=lambda w: w.inflight)
+      if worker.inflight >= self.queue_depth and len(self.workers) + self._spawning < self.max_size:
+        self._spawning += 1
+        self._spawn_in_background()
+      worker.inflight += 1
+      worker.renders += 1
+      return worker
+
+  def release(self, worker):
+    with self._lock:
+      worker.inflight -= 1
+      worker.last_used = time.monotonic()
+      drained = (self.closed or worker.draining) and not worker.inflight
+      idle = [] if self.closed else self._pop_idle(worker.last_used)
+    if drained:
+      worker.kill()
+    for w in idle:
+      w.kill()
+
+  def reap_idle(self):
+    '''
+      Stops workers idle for longer than idle_timeout, down to min_size.
+    '''
+    with self._lock:
+      idle = [] if self.closed else self._pop_idle(time.monotonic())
+    for w in idle:
+      w.kill()
+
+  def _pop_idle(self, now):
+    idle = []
+    if self.idle_timeout is None or len(self.workers) <= self.min_size: return idle
+    for w in sorted(self.workers, key=lambda w: w.last_used):
+      if len(self.workers) <= self.min_size or now - w.last_used < self.idle_timeout: break
+      if w.inflight: continue
+      self.workers.remove(w)
+      idle.append(w)
+    if idle and self.br.verbose: print('BR stopping %i idle nodejs server(s) for' % len(idle), self.deps)
+    return idle
+
+  def replace(self, worker, dead=False):
+    '''
+      Starts a new worker and swaps it in for worker, which is stopped once
+      its last render finishes.  A dead worker is taken out right away.
+    '''
+    with self._lock:
+      if self.closed or worker not in self.workers: return
+      dead = dead or worker.child.poll() is not None
+      if dead: self.workers.remove(worker)
+      self._spawning += 1
+    if dead: worker.kill()
+    try:
+      new_worker = self._spawn()
+    except Exception as e:
+      print('BR could not start nodejs server:', e)
+      new_worker = None
+    kill = []
+    with self._lock:
+      self._spawning -= 1
+      self._spawned.notify_all()
+      if new_worker and self.closed:
+        kill.append(new_worker)
+      elif new_worker:
+        self.workers.append(new_worker)
+        if worker in self.workers:
+          self.workers.remove(worker)
+          worker.draining = True
+          if not worker.inflight: kill.append(worker)
+    for w in kill:
+      w.kill()
+
+  def remove(self, worker):
+    with self._lock:
+      if worker in self.workers:
+        self.workers.remove(worker)
+    worker.kill()
+
+  def close(self):
+    '''
+      Stops all idle workers now, and busy ones once their last render finishes.
+    '''
+    with self._lock:
+      self.closed = True
+      workers, self.workers = self.workers, []
+      idle = [w for w in workers if not w.inflight]
+    for worker in idle:
+      worker.kill()
+
+
+class _Metrics(object):
+  '''
+    Event counters and per phase timing histograms, with an optional
+    on_timing(phase, seconds) callback.
+  '''
+  BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+  COUNTERS = ('context_spawns', 'context_spawn_failures', 'context_kills', 'context_evictions', 'context_respawns', 'context_hangs', 'context_recycles', 'render_failures', 'render_retries')
+
+  def __init__(self, on_timing=None):
+    self.on_timing = on_timing
+    self._counters = dict.fromkeys(self.COUNTERS, 0)
+    self._timings = {} # phase -> [count per bucket..., count, total seconds]
+    self._lock = threading.Lock()
+
+  def count(self, name, n=1):
+    with self._lock:
+      self._counters[name] = self._counters.get(name, 0) + n
+
+  def timing(self, phase, seconds):
+    with self._lock:
+      t = self._timings.get(phase)
+      if t is None:
+        t = self._timings[phase] = [0] * (len(self.BUCKETS) + 2)
+      for i in range(len(self.BUCKETS)-1, -1, -1):
+        if seconds > self.BUCKETS[i]: break
+        t[i] += 1
+      t[-2] += 1
+      t[-1] += seconds
+    if self.on_timing:
+      self.on_timing(phase, seconds)
+
+  def snapshot(self):
+    with self._lock:
+      return dict(self._counters), dict((phase, list(t)) for phase, t in self._timings.items())
+
+
+def _rss(pid):
+  # resident set size in bytes, or None where there's no /proc
+  if pid is None: return None
+  try:
+    with open('/proc/%i/statm' % pid) as f:
+      return int(f.read().split()[1]) * _PAGE_SIZE
+  except (IOError, OSError, ValueError, IndexError):
+    return None
+
+_MAX_SOCKET_PATH = 103 # sun_path is 108 bytes on linux, 104 on macos (both with the trailing NUL)
+
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+class _RenderCache(object):
+  '''
+    LRU cache of server side rendered html, bounded by entry count and/or total
+    bytes, with an optional time-to-live in seconds per entry.
+  '''
+  def __init__(self, max_size=None, max_bytes=None, ttl=None):
+    self.max_size = max_size
+    self.max_bytes = max_bytes
+    self.ttl = ttl
+    self.bytes = 0
+    self.hits = 0
+    self.misses = 0
+    self._data = collections.OrderedDict() # key -> (expires, value), oldest first
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._data)
+
+  def get(self, key):
+    with self._lock:
+      item = self._data.get(key)
+      if item is None:
+        self.misses += 1
+        return None
+      expires, value = item
+      if expires is not None and expires < time.time():
+        self._pop(key)
+        self.misses += 1
+        return None
+      self._data.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def put(self, key, value):
+    if self.max_bytes and len(value) > self.max_bytes: return
+    expires = time.time() + self.ttl if self.ttl else None
+    with self._lock:
+      self._pop(key)
+      self._data[key] = expires, value
+      self.bytes += len(value)
+      while (self.max_size and len(self._data) > self.max_size) or (self.max_bytes and self.bytes > self.max_bytes):
+        self._pop(next(iter(self._data)))
+
+  def pop(self, key):
+    with self._lock:
+      self._pop(key)
+
+  def _pop(self, key):
+    item = self._data.pop(key, None)
+    if item is not None:
+      self.bytes -= len(item[1])
+
+  def clear(self):
+    with self._lock:
+      self._data.clear()
+      self.bytes = 0
+
+
 class _ReactNode(object):
+  __slots__ = ('react_class', 'props', 'children', '_memo')
+
   def __init__(self, react_class, props, children):
     self.react_class = react_class
     self.props = self.react_class.default_props()
     if props: self.props.update(props)
-    if 'key' not in self.props:
-      self.props['key'] = '_br_%f' % random.random()
     self.children = children if children else []
+    self._memo = None
+
+  def freeze(self):
+    '''
+      Marks this subtree as immutable, so its serializations are computed once
+      and reused (for example for a node built at import time and used in
+      every request).  Don't change its props or children afterwards.
+    '''
+    if self._memo is None: self._memo = {}
+    return self
+
+  def _props_with_key(self, key):
+    # children without an explicit key get their position, so the output is
+    # deterministic (and cacheable) for the same tree
+    if key is None or 'key' in self.props: return self.props
+    props = dict(self.props)
+    props['key'] = key
+    return props
+
+  def _walk(self):
+    # depth first, parents before children (iterative, for deep trees)
+    stack = [self]
+    while stack:
+      node = stack.pop()
+      yield node
+      for i in range(len(node.children)-1, -1, -1):
+        if isinstance(node.children[i], _ReactNode):
+          stack.append(node.children[i])
 
   def get_js_files(self, files=None):
     if files is None: files = []
-    files.append(self.react_class.fn)
-    for child in self.children:
-      if isinstance(child, _ReactNode):
-        child.get_js_files(files)
+    files.extend(node.react_class.fn for node in self._walk())
     return files
 
   def get_react_classes(self, classes=None):
     if classes is None: classes = set()
-    classes.add(self.react_class.name)
-    for child in self.children:
-      if isinstance(child, _ReactNode):
-        child.get_react_classes(classes)
+    classes.update(node.react_class.name for node in self._walk())
     return classes
 
-  def to_javascript(self):
-    ret = [
-      'React.createElement(',
-        'bottlereact.%s' % self.react_class.name, ',',
-        _make_json_string_browser_safe(json.dumps(self.props)), ',',
-    ]
-    ret.append('[')
-    count = len(ret)
-    for child in self.children:
-      if isinstance(child, _ReactNode):
-        ret.append(child.to_javascript())
-      elif isinstance(child, basestring):
-        ret.append(_make_json_string_browser_safe(json.dumps(child)))
-      elif child is None:
-        pass
+  def _render_plan(self, hoisted=None, hoist_min_size=_HOIST_MIN_SIZE):
+    '''
+      (unique jsx files in tree order, frozenset of class names, javascript)
+      from one pass over the tree.
+    '''
+    plan = {}, set()
+    react_js = _make_json_string_browser_safe(self._serialize(None, True, hoisted, hoist_min_size, plan))
+    return tuple(plan[0]), frozenset(plan[1]), react_js
+
+  def _files_and_classes(self):
+    # for frozen subtrees the serializer skips
+    ret = self._memo.get('plan')
+    if ret is None:
+      ret = self._memo['plan'] = _dedup(self.get_js_files()), self.get_react_classes()
+    return ret
+
+  def to_javascript(self, key=None, hoisted=None, hoist_min_size=_HOIST_MIN_SIZE):
+    '''
+      If hoisted is a dict, prop values whose JSON is at least hoist_min_size
+      chars are added to it (JSON -> index) and written as __br_p[index].
+    '''
+    return _make_json_string_browser_safe(self._serialize(key, True, hoisted, hoist_min_size))
+
+  def to_render_json(self, key=None):
+    '''
+      to_render_tree(), already serialized to JSON
+    '''
+    return self._serialize(key, False)
+
+  def _serialize(self, key, js, hoisted=None, hoist_min_size=None, plan=None):
+    # iterative, so deep trees don't recurse, writing every piece into one list.
+    # the stack holds nodes to write as (node, key), strings to write as is, and
+    # (start, memo key, memo) to save the output of a frozen subtree.
+    out = []
+    stack = [(self, key)]
+    while stack:
+      item = stack.pop()
+      if item.__class__ is str:
+        out.append(item)
+        continue
+      if len(item) == 3:
+        start, memo_key, memo = item
+        memo[memo_key] = ''.join(out[start:])
+        continue
+      node, key = item
+      # hoisted output depends on the table, so isn't memoized
+      if node._memo is not None and hoisted is None:
+        memo_key = (js, key)
+        cached = node._memo.get(memo_key)
+        if cached is not None:
+          out.append(cached)
+          if plan is not None:
+            files, classes = node._files_and_classes()
+            plan[0].update(dict.fromkeys(files))
+            plan[1].update(classes)
+          continue
+        stack.append((len(out), memo_key, node._memo))
+      if plan is not None:
+        plan[0][node.react_class.fn] = None # an ordered set
+        plan[1].add(node.react_class.name)
+      if js:
+        props = node._props_with_key(key)
+        props = _json_dumps(props) if hoisted is None else _hoisted_props_js(props, hoisted, hoist_min_size)
+        out.append('React.createElement(bottlereact.%s,%s,[' % (node.react_class.name, props))
+        stack.append('])')
       else:
-       raise Exception('unknown child %s type %s' % (repr(child), child.__class__))
-      ret.append(',')
-    if len(ret) > count: del ret[-1] # delete the last comma
-    ret.append(']')
-    ret.append(')')
-    return ''.join(ret)
+        out.append('[%s,%s,[' % (_json_dumps(node.react_class.name), _json_dumps(node._props_with_key(key))))
+        stack.append(']]')
+      children = []
+      for i, child in enumerate(node.children):
+        if isinstance(child, _ReactNode):
+          children.append((child, '_br_%i' % i))
+        elif isinstance(child, basestring):
+          children.append(_json_dumps(child))
+        elif child is None:
+          pass
+        else:
+         raise Exception('unknown child %s type %s' % (repr(child), child.__class__))
+      for i in range(len(children)-1, -1, -1):
+        stack.append(children[i])
+        if i: stack.append(',')
+    return ''.join(out)
+
+  def to_render_tree(self, key=None):
+    '''
+      JSON-able [class_name, props, children] for the nodejs render server
+    '''
+    # iterative, so deep trees don't recurse; child nodes fill in their
+    # placeholder in the parent's children
+    root = [None]
+    stack = [(self, key, root, 0)]
+    while stack:
+      node, key, parent, index = stack.pop()
+      children = []
+      parent[index] = [node.react_class.name, node._props_with_key(key), children]
+      for i, child in enumerate(node.children):
+        if isinstance(child, _ReactNode):
+          stack.append((child, '_br_%i' % i, children, len(children)))
+          children.append(None)
+        elif isinstance(child, basestring):
+          children.append(child)
+        elif child is None:
+          pass
+        else:
+         raise Exception('unknown child %s type %s' % (repr(child), child.__class__))
+    return root[0]
 
 
 class _ReactClass(object):
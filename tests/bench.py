@@ -0,0 +1,270 @@
+'''
+  Benchmarks for bottlereact.  Run from this directory:
+
+    python bench.py [--quick] [--stand-in] [--filter SUBSTRING] [--output FILE]
+
+  Every benchmark runs against a generated project (N jsx files, M assets) in a
+  temp dir, and reports throughput, latency percentiles and the peak Python
+  memory of one call.  Results are printed and written as JSON, so runs of two
+  releases can be compared.  Server side rendering uses a real Node.js context,
+  or with --stand-in (or if Node.js isn't around) a Python render server that
+  answers every request with the same html, which measures only our side.
+'''
+
+from __future__ import print_function
+
+import argparse, gc, json, os, platform, resource, shutil, socketserver, subprocess, sys, tempfile, threading, time, tracemalloc
+import http.server
+import bottle
+import bottlereact
+
+
+BOX_JSX = '''// require react-with-addons.js
+// require react-dom.js
+
+var Box = React.createClass({
+  render: function() {
+    return (
+      <div className={this.props.className}>{this.props.children}</div>
+    );
+  }
+})
+
+bottlereact._register('Box', Box)
+'''
+
+COMPONENT_JSX = '''// require box.jsx
+%s
+var %s = React.createClass({
+  render: function() {
+    return (
+      <Box className='%s'>
+        <span>{this.props.name}</span>
+        {this.props.children}
+      </Box>
+    );
+  }
+})
+
+bottlereact._register('%s', %s)
+'''
+
+
+def make_project(path, n_jsx, n_assets, asset_size=4096):
+  '''
+    Writes jsx/ and assets/ under path: box.jsx plus n_jsx components (each
+    requiring the previous one, and one of the n_assets generated assets).
+  '''
+  jsx_path = os.path.join(path, 'jsx')
+  asset_path = os.path.join(path, 'assets')
+  os.makedirs(jsx_path)
+  shutil.copytree('assets', asset_path)
+  for i in range(n_assets):
+    ext = '.css' if i % 2 else '.js'
+    with open(os.path.join(asset_path, 'asset_%i%s' % (i, ext)), 'w') as f:
+      line = '.a%i { color: red; }\n' % i if ext == '.css' else 'var a%i = %i;\n' % (i, i)
+      f.write(line * (asset_size // len(line)))
+  with open(os.path.join(jsx_path, 'box.jsx'), 'w') as f:
+    f.write(BOX_JSX)
+  for i in range(n_jsx):
+    reqs = []
+    if i: reqs.append('// require c%i.jsx' % (i-1))
+    if n_assets: reqs.append('// require asset_%i%s' % (i % n_assets, '.css' if i % n_assets % 2 else '.js'))
+    name = 'C%i' % i
+    with open(os.path.join(jsx_path, 'c%i.jsx' % i), 'w') as f:
+      f.write(COMPONENT_JSX % ('\n'.join(reqs), name, name, name, name))
+  return jsx_path, asset_path
+
+
+def deep_tree(br, depth):
+  node = br.Box({'className':'leaf'})
+  for i in range(depth):
+    node = br.Box({'className':'d%i' % i}, [node])
+  return node
+
+def wide_tree(br, width, classes=('Box',)):
+  return br.Box({'className':'root'}, [getattr(br, classes[i % len(classes)])({'name':'n%i' % i}) for i in range(width)])
+
+def large_props_tree(br, width, size):
+  # the same big value on every child, and a distinct one on each
+  shared = {'rows': [{'id':i, 'label':'row %i' % i} for i in range(size // 24)]}
+  return br.Box({'className':'root'}, [br.Box({'className':'c', 'shared':shared, 'own':'x%i' % i * (size // 8)}) for i in range(width)])
+
+
+def measure(fn, min_time, min_iterations, max_iterations):
+  fn() # warm up
+  times = []
+  start = time.perf_counter()
+  while len(times) < max_iterations and (len(times) < min_iterations or time.perf_counter() - start < min_time):
+    t = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - t)
+  times.sort()
+  def percentile(p):
+    return times[min(len(times)-1, int(len(times) * p / 100.))]
+  gc.collect()
+  tracemalloc.start()
+  fn()
+  peak = tracemalloc.get_traced_memory()[1]
+  tracemalloc.stop()
+  return {
+    'iterations': len(times),
+    'ops_per_sec': len(times) / sum(times),
+    'mean_ms': 1000 * sum(times) / len(times),
+    'p50_ms': 1000 * percentile(50),
+    'p90_ms': 1000 * percentile(90),
+    'p99_ms': 1000 * percentile(99),
+    'max_ms': 1000 * times[-1],
+    'peak_python_bytes': peak,
+  }
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  html = b'<div>' + b'<span>stand-in</span>' * 64 + b'</div>'
+
+  def do_POST(self):
+    self.rfile.read(int(self.headers['Content-Length']))
+    self.send_response(200)
+    self.send_header('Content-Length', str(len(self.html)))
+    self.end_headers()
+    self.wfile.write(self.html)
+
+  def log_message(self, *args):
+    pass
+
+class _StandInServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+class _StandInChild(object):
+  # what _RenderWorker expects of a Node.js process
+  def __init__(self, server):
+    self.server = server
+  def poll(self):
+    return None
+  def terminate(self):
+    self.server.shutdown()
+    self.server.server_close()
+  def kill(self):
+    pass
+  def wait(self, timeout=None):
+    return 0
+
+class StandInBottleReact(bottlereact.BottleReact):
+  '''
+    Renders with a Python http server on the context's unix socket instead of
+    Node.js.
+  '''
+  def _init_render_server(self):
+    self._inited_render_server = True
+
+  def build_js_context(self, deps):
+    sock_fn = self._socket_fn()
+    server = _StandInServer(sock_fn, _StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return sock_fn, _StandInChild(server)
+
+
+def have_node():
+  try:
+    subprocess.check_output(['node', '-e', 'require("node-jsdom")'], stderr=subprocess.STDOUT, env=dict(os.environ, NODE_PATH=subprocess.check_output(['npm', 'root', '-g']).decode().strip()))
+    return True
+  except (OSError, subprocess.CalledProcessError):
+    return False
+
+
+def benchmarks(args, work):
+  n_jsx, n_assets, width, depth = (20, 10, 200, 200) if args.quick else (200, 100, 2000, 1000)
+  jsx_path, asset_path = make_project(os.path.join(work, 'project'), n_jsx, n_assets)
+  kwargs = {'jsx_path':jsx_path, 'asset_path':asset_path, 'verbose':False}
+  cls = StandInBottleReact if args.stand_in else bottlereact.BottleReact
+  prod_work = os.path.join(work, 'prod')
+  br = cls(bottle.Bottle(), prod=True, work_path=prod_work, **kwargs)
+  compiled = cls(bottle.Bottle(), prod=True, work_path=prod_work, compile_templates=True, **kwargs)
+  classes = ['C%i' % i for i in range(n_jsx)]
+
+  deep = deep_tree(br, depth)
+  wide = wide_tree(br, width)
+  wide_mixed = wide_tree(br, width, classes)
+  large = large_props_tree(br, width // 10, 8192)
+  yield 'to_javascript/deep', {'depth':depth}, deep.to_javascript
+  yield 'to_javascript/wide', {'width':width}, wide.to_javascript
+  yield 'to_javascript/large_props', {'width':width // 10, 'prop_bytes':8192}, large.to_javascript
+  yield 'to_javascript/wide_frozen', {'width':width}, wide_tree(br, width).freeze().to_javascript
+  yield 'to_render_json/wide', {'width':width}, wide.to_render_json
+  yield 'render_html/hello', {}, lambda: br.render_html(br.Box({'className':'x'}))
+  yield 'render_html/wide_mixed', {'width':width, 'classes':n_jsx}, lambda: br.render_html(wide_mixed)
+  yield 'render_html/wide_mixed_compiled', {'width':width, 'classes':n_jsx}, lambda: compiled.render_html(wide_mixed)
+  yield 'render_html/large_props', {'width':width // 10, 'prop_bytes':8192}, lambda: br.render_html(large)
+  yield 'render_html/large_props_hoisted', {'width':width // 10, 'prop_bytes':8192}, lambda: br.render_html(large, hoist_props=True)
+
+  ssr = {'render_server':'stand-in' if args.stand_in else 'nodejs'}
+  small = wide_tree(br, 10, classes)
+  br.prewarm([small, wide_mixed])
+  yield 'render_server/small', dict(ssr, width=10), lambda: br.render_html(small, render_server=True)
+  yield 'render_server/wide_mixed', dict(ssr, width=width), lambda: br.render_html(wide_mixed, render_server=True)
+  yield 'render_server/stream', dict(ssr, width=width), lambda: ''.join(br.render_html(wide_mixed, render_server=True, stream=True))
+  yield 'render_server/concurrent_x8', dict(ssr, width=10), lambda: run_concurrently(8, lambda: br.render_html(small, render_server=True))
+
+  startup = {'jsx_files':n_jsx + 1, 'assets':n_assets + 2}
+  def cold():
+    path = tempfile.mkdtemp(dir=work)
+    try:
+      bottlereact.BottleReact(bottle.Bottle(), prod=True, work_path=path, **kwargs)
+    finally:
+      shutil.rmtree(path)
+  yield 'startup/prod_cold', startup, cold
+  yield 'startup/prod_warm', startup, lambda: bottlereact.BottleReact(bottle.Bottle(), prod=True, work_path=prod_work, **kwargs)
+  yield 'startup/dev', startup, lambda: bottlereact.BottleReact(bottle.Bottle(), prod=False, work_path=os.path.join(work, 'dev'), **kwargs)
+
+
+def run_concurrently(n, fn):
+  threads = [threading.Thread(target=fn) for i in range(n)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+
+
+def main():
+  parser = argparse.ArgumentParser(description='bottlereact benchmarks')
+  parser.add_argument('--quick', action='store_true', help='smaller inputs and fewer iterations')
+  parser.add_argument('--stand-in', action='store_true', help='server side render with a Python stand-in instead of Node.js')
+  parser.add_argument('--filter', default='', help='only run benchmarks whose name contains this')
+  parser.add_argument('--output', help='write the JSON results here (default: stdout only)')
+  args = parser.parse_args()
+  if not args.stand_in and not have_node():
+    print('Node.js (with node-jsdom) not found, using the stand-in render server', file=sys.stderr)
+    args.stand_in = True
+  min_time, min_iterations, max_iterations = (.5, 3, 1000) if args.quick else (2, 10, 100000)
+
+  results = []
+  work = tempfile.mkdtemp(prefix='br_bench_')
+  try:
+    for name, params, fn in benchmarks(args, work):
+      if args.filter not in name: continue
+      if name.startswith('startup/'):
+        ret = measure(fn, 0, 3 if args.quick else 5, 5)
+      else:
+        ret = measure(fn, min_time, min_iterations, max_iterations)
+      ret.update({'name':name, 'params':params})
+      results.append(ret)
+      print('%-36s %10.1f ops/s  p50 %8.3f ms  p99 %8.3f ms  peak %8.1f KiB' % (name, ret['ops_per_sec'], ret['p50_ms'], ret['p99_ms'], ret['peak_python_bytes'] / 1024.), file=sys.stderr)
+  finally:
+    shutil.rmtree(work, ignore_errors=True)
+
+  report = {
+    'bottlereact': bottlereact.__version__,
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'orjson': bottlereact.ORJSON_AROUND,
+    'quick': args.quick,
+    'max_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'results': results,
+  }
+  out = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      f.write(out + '\n')
+  print(out)
+
+if __name__ == '__main__':
+  main()
@@ -1,8 +1,52 @@
-import unittest
+import asyncio, functools, gzip, hashlib, http.server, io, json, os, re, shutil, signal, socketserver, tempfile, threading, time, unittest
 import bottle
 import bottlereact
 
 
+def get(app, path, headers=None):
+  environ = {'REQUEST_METHOD':'GET', 'PATH_INFO':path, 'wsgi.input':io.BytesIO()}
+  for k,v in (headers or {}).items():
+    environ['HTTP_'+ k.upper().replace('-','_')] = v
+  ret = {}
+  def start_response(status, response_headers, exc_info=None):
+    ret['status'] = int(status.split()[0])
+    ret['headers'] = dict((k.title(), v) for k,v in response_headers)
+  body = b''.join(app(environ, start_response))
+  return ret['status'], ret['headers'], body
+
+def stand_in_build_js_context(br, html=b'hello'):
+  '''
+    A build_js_context for br that answers every render with html from a
+    Python server, instead of starting nodejs.
+  '''
+  class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    def do_POST(self):
+      self.rfile.read(int(self.headers['Content-Length']))
+      self.send_response(200)
+      self.send_header('Content-Length', str(len(html)))
+      self.end_headers()
+      self.wfile.write(html)
+    def log_message(self, *args):
+      pass
+  class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+  class Child(object):
+    pid = None
+    def __init__(self, server): self.server = server
+    def poll(self): return None
+    def terminate(self):
+      self.server.shutdown()
+      self.server.server_close()
+    def kill(self): pass
+  def build_js_context(deps):
+    sock_fn = br._socket_fn()
+    server = Server(sock_fn, Handler)
+    threading.Thread(target=server.serve_forever, args=(.01,), daemon=True).start()
+    return sock_fn, Child(server)
+  return build_js_context
+
+
 class TestBottleReact(unittest.TestCase):
 
   def test_hello_world(self):
@@ -14,6 +58,394 @@ class TestBottleReact(unittest.TestCase):
     self.assertTrue('-hello_world.js"></script>' in html)
     self.assertTrue('React.createElement(bottlereact.HelloWorld,{},[])' in html)
 
+  def test_manifest_skips_rehashing(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    self.assertTrue(os.path.exists('/tmp/bottlereact/manifest.json'))
+    sha256_file = bottlereact._sha256_file
+    def f(fn):
+      raise AssertionError('%s was rehashed' % fn)
+    bottlereact._sha256_file = f
+    try:
+      br2 = bottlereact.BottleReact(app, prod=True)
+    finally:
+      bottlereact._sha256_file = sha256_file
+    self.assertEqual(br._fn2hash, br2._fn2hash)
+
+  def test_transform_jsx_files(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, build_workers=2)
+    work = tempfile.mkdtemp()
+    todo = [
+      ('hello_world.jsx', 'jsx/hello_world.jsx', os.path.join(work, 'a.js')),
+      ('also.jsx', 'jsx/hello_world.jsx', os.path.join(work, 'b.js')),
+    ]
+    br._transform_jsx_files(todo)
+    self.assertEqual(sorted(os.listdir(work)), ['a.js', 'b.js'])
+    with open(os.path.join(work, 'b.js')) as f:
+      self.assertTrue('React.createElement' in f.read())
+    with open(os.path.join(work, 'bad.jsx'), 'w') as f:
+      f.write('var x = <div>;')
+    todo.append(('bad.jsx', os.path.join(work, 'bad.jsx'), os.path.join(work, 'bad.js')))
+    with self.assertRaises(Exception) as cm:
+      br._transform_jsx_files(todo)
+    self.assertTrue('bad.jsx' in str(cm.exception))
+    self.assertFalse('hello_world.jsx' in str(cm.exception))
+    self.assertFalse(os.path.exists(os.path.join(work, 'bad.js')))
+    shutil.rmtree(work)
+
+  def test_fetch_ext_deps(self):
+    served = tempfile.mkdtemp()
+    with open(os.path.join(served, 'lib.js'), 'w') as f:
+      f.write('var lib = 1;')
+    handler = functools.partial(http.server.SimpleHTTPRequestHandler, directory=served)
+    handler.log_message = lambda *args: None
+    server = http.server.HTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%i/lib.js' % server.server_address[1]
+    work = tempfile.mkdtemp()
+    jsx = os.path.join(work, 'jsx')
+    os.makedirs(jsx)
+    with open(os.path.join(jsx, 'x.jsx'), 'w') as f:
+      f.write('// require %s\n' % url)
+    lock_fn = os.path.join(work, 'lock.json')
+    try:
+      with open(lock_fn, 'w') as f:
+        json.dump({url: 'bad'}, f)
+      with self.assertRaises(Exception):
+        bottlereact.BottleReact(bottle.Bottle(), prod=True, jsx_path=jsx, work_path=work, ext_lock_file=lock_fn)
+      self.assertEqual(os.listdir(os.path.join(work, 'ext-assets')), [])
+      br = bottlereact.BottleReact(bottle.Bottle(), prod=True, jsx_path=jsx, work_path=work, offline=True)
+      self.assertFalse(url in br._fn2hash)
+      with open(lock_fn, 'w') as f:
+        json.dump({url: hashlib.sha256(b'var lib = 1;').hexdigest()}, f)
+      br = bottlereact.BottleReact(bottle.Bottle(), prod=True, jsx_path=jsx, work_path=work, ext_lock_file=lock_fn)
+      self.assertTrue(bottlereact._make_string_fn_safe(url) in br._fn2hash)
+    finally:
+      server.shutdown()
+      shutil.rmtree(served)
+      shutil.rmtree(work)
+
+  def test_jsx_index(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    scan_jsx_file = bottlereact._scan_jsx_file
+    def f(path):
+      raise AssertionError('%s was rescanned' % path)
+    bottlereact._scan_jsx_file = f
+    try:
+      br2 = bottlereact.BottleReact(app, prod=True)
+    finally:
+      bottlereact._scan_jsx_file = scan_jsx_file
+    self.assertEqual(br._reqs, br2._reqs)
+    self.assertEqual(br2._class_fns, {'HelloWorld': 'hello_world.jsx'})
+
+  def test_lazy_react_classes(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    self.assertFalse('HelloWorld' in br.__dict__)
+    self.assertEqual(br.HelloWorld.fn, 'hello_world.jsx')
+    self.assertTrue(br.HelloWorld is br.__dict__['HelloWorld'])
+    with self.assertRaises(AttributeError):
+      br.GoodbyeWorld
+
+  def test_dev_transpile(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, dev_transpile=True, verbose=False)
+    html = br.render_html(br.HelloWorld())
+    self.assertFalse('babel' in html)
+    self.assertTrue('<script src="/__br_assets__/hello_world.jsx"></script>' in html)
+    status, headers, body = get(app, '/__br_assets__/hello_world.jsx')
+    self.assertEqual(status, 200)
+    self.assertEqual(headers['Content-Type'], 'text/javascript')
+    self.assertTrue(b'React.createElement' in body)
+    transform_jsx = bottlereact._transform_jsx
+    def f(*args):
+      raise AssertionError('retransformed')
+    bottlereact._transform_jsx = f
+    try:
+      self.assertEqual(get(app, '/__br_assets__/hello_world.jsx')[2], body)
+      br2 = bottlereact.BottleReact(bottle.Bottle(), dev_transpile=True, verbose=False)
+      self.assertEqual(br2._transpile('hello_world.jsx'), body.decode())
+    finally:
+      bottlereact._transform_jsx = transform_jsx
+
+  def test_watch_rebuilds_context(self):
+    work = tempfile.mkdtemp()
+    shutil.copytree('jsx', os.path.join(work, 'jsx'))
+    shutil.copytree('assets', os.path.join(work, 'assets'))
+    jsx_fn = os.path.join(work, 'jsx', 'hello_world.jsx')
+    br = bottlereact.BottleReact(bottle.Bottle(), jsx_path=os.path.join(work, 'jsx'), asset_path=os.path.join(work, 'assets'), work_path=work, verbose=False, watch=True, watch_interval=.1)
+    try:
+      html = br.render_html(br.HelloWorld(), render_server=True)
+      self.assertTrue('Thanks for trying' in html)
+      pool = list(br._ctxs.values())[0]
+      with open(jsx_fn) as f:
+        jsx = f.read()
+      with open(jsx_fn, 'w') as f:
+        f.write(jsx.replace('Thanks for trying', 'Thanks for testing'))
+      for i in range(100):
+        if list(br._ctxs.values()) != [pool]: break
+        time.sleep(.1)
+      self.assertTrue(pool.closed)
+      html = br.render_html(br.HelloWorld(), render_server=True)
+      self.assertTrue('Thanks for testing' in html)
+    finally:
+      br.stop_watching()
+      for pool in br._ctxs.values(): pool.close()
+      shutil.rmtree(work)
+
+  def test_dep_closures(self):
+    work = tempfile.mkdtemp()
+    jsx_path = os.path.join(work, 'jsx')
+    os.makedirs(jsx_path)
+    def write(fn, reqs, name):
+      with open(os.path.join(jsx_path, fn), 'w') as f:
+        f.write(''.join('// require %s\n' % req for req in reqs))
+        f.write('var %s = React.createClass({});\n' % name)
+    write('a.jsx', ['b.jsx', 'c.jsx', 'a.css'], 'A')
+    write('b.jsx', ['c.jsx'], 'B')
+    write('c.jsx', ['c.css'], 'C')
+    try:
+      br = bottlereact.BottleReact(bottle.Bottle(), jsx_path=jsx_path, work_path=work, verbose=False)
+      self.assertEqual(br._closures['a.jsx'], ('c.css', 'c.jsx', 'b.jsx', 'a.css', 'a.jsx'))
+      node = br.C({}, [br.B(), br.A(), br.C()])
+      self.assertEqual(node._render_plan()[:2], (('c.jsx', 'b.jsx', 'a.jsx'), frozenset(['A', 'B', 'C'])))
+      deps = br._build_dep_list(node.get_js_files())
+      self.assertEqual(deps[2:], ['c.css', 'c.jsx', 'b.jsx', 'a.css', 'a.jsx'])
+      self.assertIn('_onLoad(["A", "B", "C"]', br.render_html(node))
+      # the same plan from a frozen subtree
+      frozen = br.B({}, [br.A()]).freeze()
+      for i in range(2):
+        self.assertEqual(br.C({}, [frozen])._render_plan()[:2], (('c.jsx', 'b.jsx', 'a.jsx'), frozenset(['A', 'B', 'C'])))
+      # prewarm() only starts contexts for files nothing else requires
+      started = []
+      br._init_render_server = lambda: None
+      br.get_js_context = started.append
+      br.prewarm()
+      self.assertEqual(started, [tuple(br._build_dep_list(['a.jsx']))])
+      write('c.jsx', ['a.jsx'], 'C')
+      with self.assertRaisesRegex(Exception, 'a.jsx -> b.jsx -> c.jsx -> a.jsx'):
+        bottlereact.BottleReact(bottle.Bottle(), jsx_path=jsx_path, work_path=work, verbose=False)
+    finally:
+      shutil.rmtree(work)
+
+  def test_watch_clears_render_cache(self):
+    work = tempfile.mkdtemp()
+    shutil.copytree('jsx', os.path.join(work, 'jsx'))
+    shutil.copytree('assets', os.path.join(work, 'assets'))
+    jsx_fn = os.path.join(work, 'jsx', 'hello_world.jsx')
+    br = bottlereact.BottleReact(bottle.Bottle(), jsx_path=os.path.join(work, 'jsx'), asset_path=os.path.join(work, 'assets'), work_path=work, verbose=False, watch=True, watch_interval=.1, render_cache_size=10)
+    try:
+      html = br.render_html(br.HelloWorld(), render_server=True)
+      self.assertTrue('Thanks for trying' in html)
+      pool = list(br._ctxs.values())[0]
+      with open(jsx_fn) as f:
+        jsx = f.read()
+      with open(jsx_fn, 'w') as f:
+        f.write(jsx.replace('Thanks for trying', 'Thanks for testing'))
+      for i in range(100):
+        if list(br._ctxs.values()) != [pool]: break
+        time.sleep(.1)
+      html = br.render_html(br.HelloWorld(), render_server=True)
+      self.assertTrue('Thanks for testing' in html)
+    finally:
+      br.stop_watching()
+      for pool in br._ctxs.values(): pool.close()
+      shutil.rmtree(work)
+
+  def test_jsx_index_shared_work_path(self):
+    work = tempfile.mkdtemp()
+    try:
+      for name in ['one', 'two']:
+        shutil.copytree('jsx', os.path.join(work, name))
+        bottlereact.BottleReact(bottle.Bottle(), jsx_path=os.path.join(work, name), work_path=work, verbose=False)
+      with open(os.path.join(work, 'jsx-index.json')) as f:
+        index = json.load(f)
+      self.assertEqual(sorted(index), [os.path.join(work, name, 'hello_world.jsx') for name in ['one', 'two']])
+      # neither rescans the other's files
+      scan = bottlereact._scan_jsx_file
+      def f(path):
+        raise AssertionError('%s was rescanned' % path)
+      bottlereact._scan_jsx_file = f
+      try:
+        for name in ['one', 'two']:
+          bottlereact.BottleReact(bottle.Bottle(), jsx_path=os.path.join(work, name), work_path=work, verbose=False)
+      finally:
+        bottlereact._scan_jsx_file = scan
+    finally:
+      shutil.rmtree(work)
+
+  def test_bundle(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, bundle=True)
+    html = br.render_html(br.HelloWorld())
+    scripts = re.findall('<script src="/__br_assets__/([^"]*)"></script>', html)
+    self.assertEqual(len(scripts), 1)
+    self.assertTrue(scripts[0].endswith('-bundle.js'))
+    status, headers, body = get(app, '/__br_assets__/'+ scripts[0])
+    self.assertEqual(status, 200)
+    self.assertTrue(body.index(b'var pending_deps') < body.index(b'var HelloWorld'))
+    self.assertEqual(br._bundle_deps(br._build_dep_list(['hello_world.jsx'])), scripts)
+
+  def test_bundle_vendor(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, bundle=True, bundle_vendor=['react-with-addons.js', 'react-dom.js'])
+    html = br.render_html(br.HelloWorld())
+    scripts = re.findall('<script src="/__br_assets__/([^"]*)"></script>', html)
+    self.assertEqual(len(scripts), 2)
+    with open(os.path.join(br.hashed_path, scripts[0]), 'rb') as f:
+      self.assertFalse(b'var HelloWorld' in f.read())
+
+  def test_precompress(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, precompress=True)
+    path = br.get_asset_path('react-with-addons.js')
+    self.assertTrue(os.path.exists(os.path.join(br.hashed_path, path.split('/')[-1] +'.gz')))
+    status, headers, raw = get(app, path)
+    self.assertEqual(status, 200)
+    self.assertFalse('Content-Encoding' in headers)
+    self.assertEqual(headers['Vary'], 'Accept-Encoding')
+    status, headers, body = get(app, path, {'Accept-Encoding':'gzip, deflate'})
+    self.assertEqual(headers['Content-Encoding'], 'gzip')
+    self.assertTrue(headers['Content-Type'].startswith('text/javascript'))
+    self.assertTrue(len(body) < len(raw))
+    self.assertEqual(gzip.decompress(body), raw)
+    status, headers, body = get(app, path, {'Accept-Encoding':'gzip;q=0'})
+    self.assertFalse('Content-Encoding' in headers)
+    status, headers, body = get(app, path, {'Accept-Encoding':'gzip', 'Range':'bytes=0-99'})
+    self.assertEqual(status, 206)
+    self.assertFalse('Content-Encoding' in headers)
+    self.assertEqual(body, raw[:100])
+
+  def test_precompress_remembers_incompressible_files(self):
+    work = tempfile.mkdtemp()
+    try:
+      asset_path = os.path.join(work, 'assets')
+      shutil.copytree('assets', asset_path)
+      with open(os.path.join(asset_path, 'tiny.js'), 'w') as f:
+        f.write('x')
+      kwargs = {'asset_path':asset_path, 'work_path':work, 'prod':True, 'precompress':True, 'verbose':False}
+      br = bottlereact.BottleReact(bottle.Bottle(), **kwargs)
+      fn = os.path.join(br.hashed_path, br.get_asset_path('tiny.js').split('/')[-1])
+      self.assertFalse(os.path.exists(fn +'.gz'))
+      self.assertTrue(os.path.exists(os.path.join(br.hashed_path, br.get_asset_path('react-with-addons.js').split('/')[-1] +'.gz')))
+      compress = gzip.compress
+      compressed = []
+      gzip.compress = lambda data, *args, **kwargs: compressed.append(data) or compress(data, *args, **kwargs)
+      try:
+        bottlereact.BottleReact(bottle.Bottle(), **kwargs)
+      finally:
+        gzip.compress = compress
+      self.assertEqual(compressed, [])
+    finally:
+      shutil.rmtree(work)
+
+  @unittest.skipUnless(bottlereact.RJSMIN_AROUND, 'rjsmin not installed')
+  def test_minify(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, minify=True)
+    self.assertTrue(br._fn2hash['hello_world.jsx'].endswith('.min.js'))
+    html = br.render_html(br.HelloWorld())
+    self.assertTrue('-hello_world.min.js"></script>' in html)
+
+  def test_asset_cache(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, precompress=True, asset_cache_bytes=1<<17)
+    path = br.get_asset_path('hello_world.jsx')
+    self.assertTrue(path.split('/')[-1] in br._asset_cache._data)
+    self.assertFalse(br.get_asset_path('react-with-addons.js').split('/')[-1] in br._asset_cache._data) # too big
+    with open(os.path.join(br.hashed_path, path.split('/')[-1]), 'rb') as f:
+      raw = f.read()
+    status, headers, body = get(app, path)
+    self.assertEqual(status, 200)
+    self.assertEqual(body, raw)
+    self.assertEqual(headers['Etag'], '"%s"' % path.split('/')[-1].split('-')[0])
+    self.assertTrue(headers['Content-Type'].startswith('text/javascript'))
+    status, headers, body = get(app, path, {'If-None-Match':headers['Etag']})
+    self.assertEqual(status, 304)
+    self.assertEqual(body, b'')
+    status, headers, body = get(app, path, {'Accept-Encoding':'gzip'})
+    self.assertEqual(headers['Content-Encoding'], 'gzip')
+    self.assertTrue(headers['Etag'].endswith('.gz"'))
+    self.assertEqual(gzip.decompress(body), raw)
+    status, headers, body = get(app, br.get_asset_path('react-with-addons.js'))
+    self.assertEqual(status, 200)
+    self.assertTrue(len(body) > 1<<17)
+
+  def test_preload(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    @app.get('/')
+    def index():
+      return br.render_html(br.HelloWorld(), preload=True)
+    status, headers, body = get(app, '/')
+    path = br.get_asset_path('hello_world.jsx')
+    self.assertTrue(('<link rel="preload" href="%s" as="script">' % path).encode() in body)
+    self.assertTrue(('<%s>; rel=preload; as=script' % path) in headers['Link'])
+    self.assertTrue(body.index(b'rel="preload"') < body.index(b'<script src='))
+
+  def test_inline_assets(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    html = br.render_html(br.HelloWorld(), inline_assets_under=1000, init_nonce='xyz')
+    self.assertFalse('-hello_world.js"></script>' in html)
+    self.assertTrue('<script nonce="xyz">// require react-with-addons.js' in html)
+    self.assertTrue('-react-dom.js"></script>' in html)
+
+  def test_script_loading_defer(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    html = br.render_html(br.HelloWorld(), script_loading='defer')
+    self.assertTrue('-hello_world.js" defer></script>' in html)
+    self.assertTrue("document.addEventListener('DOMContentLoaded'" in html)
+    # inlined scripts would run before the deferred ones
+    html = br.render_html(br.HelloWorld(), script_loading='defer', inline_assets_under=100000)
+    self.assertTrue('-hello_world.js" defer></script>' in html)
+    self.assertTrue('-react-dom.js" defer></script>' in html)
+    self.assertFalse('<script>// require' in html)
+
+  def test_hoist_props(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    user = {'name':'</script>', 'tags':['a','b','c'], 'bio':'x'*40}
+    node = br.HelloWorld({'user':user, 'n':1}, [br.HelloWorld({'user':user})])
+    html = br.render_html(node, hoist_props=True)
+    blob = re.search(r'<script type="application/json" id="__br_props__">(.*?)</script>', html).group(1)
+    self.assertNotIn('</', blob)
+    # the repeated value is stored once
+    self.assertEqual(json.loads(blob), [user])
+    self.assertIn('{"user":__br_p[0],"n":1}', html)
+    self.assertIn('{"user":__br_p[0],"key":"_br_0"}', html)
+    self.assertIn("JSON.parse(document.getElementById('__br_props__').textContent)", html)
+    self.assertNotIn('__br_props__', br.render_html(node))
+
+  def test_compile_templates(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    compiled = bottlereact.BottleReact(app, prod=True, compile_templates=True)
+    template = '<script nonce="{{get("init_nonce", "")}}"></script>{{! deps }}{{! init }}{{! body or "Loading..." }}'
+    for i in range(3):
+      for kwargs in [{}, {'init_nonce':'n%i' % i}, {'render_server':True}, {'template':template, 'init_nonce':'n%i' % i}, {'template':template, 'render_server':True}]:
+        self.assertEqual(compiled.render_html(compiled.HelloWorld({'i':i}), **kwargs), br.render_html(br.HelloWorld({'i':i}), **kwargs))
+    self.assertEqual(len(compiled._templates), 5)
+    # template escapes the nonce, so with one it's rendered every time
+    self.assertEqual(sorted(bool(parts) for expires, parts in compiled._templates._data.values()), [False, True, True, True, True])
+    nonce = 'x"><img src=x onerror=alert(1)>'
+    for i in range(3):
+      html = compiled.render_html(compiled.HelloWorld(), template=template, init_nonce=nonce)
+      self.assertEqual(html, br.render_html(br.HelloWorld(), template=template, init_nonce=nonce))
+      self.assertTrue('<script nonce="x&quot;&gt;&lt;img' in html)
+    # escaping deps can't be compiled, so it's rendered every time
+    template = '{{ deps }}{{! init }}'
+    for i in range(2):
+      self.assertEqual(compiled.render_html(compiled.HelloWorld(), template=template), br.render_html(br.HelloWorld(), template=template))
+    self.assertEqual(compiled._templates._data[next(reversed(compiled._templates._data))][1], ())
+    # kwargs that change every request are never compiled
+    for i in range(3):
+      self.assertEqual(compiled.render_html(compiled.HelloWorld(), title='t%i' % i), br.render_html(br.HelloWorld(), title='t%i' % i))
+    self.assertEqual(len(compiled._templates), 6)
+
   def test_kwarg(self):
     app = bottle.Bottle()
     br = bottlereact.BottleReact(app, prod=True)
@@ -58,10 +490,464 @@ class TestBottleReact(unittest.TestCase):
     html = br.render_html(br.HelloWorld(), render_server=True)
     self.assertTrue('Thanks for trying' in html)
     self.assertEqual(len(br._ctxs), 1)
-    port, child = list(br._ctxs.values())[0]
-    child.kill()
+    pool = list(br._ctxs.values())[0]
+    pool.workers[0].child.kill()
     html = br.render_html(br.HelloWorld(), render_server=True)
+    self.assertTrue('Thanks for trying' in html)
     self.assertEqual(len(br._ctxs), 1)
+
+  def test_metrics(self):
+    app = bottle.Bottle()
+    timings = []
+    br = bottlereact.BottleReact(app, prod=True, metrics_path='/__br_metrics__', on_timing=lambda phase, seconds: timings.append(phase), render_cache_size=10)
+    try:
+      br.render_html(br.HelloWorld(), render_server=True)
+      self.assertEqual(timings, ['serialize', 'deps', 'build_js_context', 'render_server', 'template'])
+      pool = list(br._ctxs.values())[0]
+      pool.workers[0].child.kill()
+      pool.workers[0].child.wait()
+      br.render_html(br.HelloWorld({'name':'x'}), render_server=True)
+      br.render_html(br.HelloWorld({'name':'x'}), render_server=True)
+      m = br.metrics()
+      self.assertEqual(m['counters']['context_spawns'], 2)
+      self.assertEqual(m['counters']['context_kills'], 1)
+      self.assertEqual(m['counters']['render_retries'], 1)
+      self.assertEqual(m['counters']['render_cache_hits'], 1)
+      self.assertEqual(m['timings']['render_server']['count'], 2)
+      self.assertEqual(m['contexts'], 1)
+      self.assertTrue(m['workers'][0]['rss_bytes'] > 0)
+      status, headers, body = get(app, '/__br_metrics__')
+      self.assertEqual(status, 200)
+      self.assertTrue(headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+      body = body.decode()
+      self.assertIn('\nbottlereact_context_spawns_total 2\n', body)
+      self.assertIn('bottlereact_phase_seconds_count{phase="render_server"} 2\n', body)
+      self.assertIn('bottlereact_phase_seconds_bucket{phase="render_server",le="+Inf"} 2\n', body)
+      self.assertIn('\nbottlereact_workers 1\n', body)
+    finally:
+      for pool in br._ctxs.values(): pool.close()
+
+  def test_pool_stops_idle_workers(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_pool_max=2, render_pool_idle_timeout=.3)
+    br.render_html(br.HelloWorld(), render_server=True)
+    pool = list(br._ctxs.values())[0]
+    try:
+      busy = pool.acquire()
+      pool.release(pool.acquire()) # every worker busy, so a second one starts
+      for i in range(100):
+        if len(pool.workers) == 2: break
+        time.sleep(.1)
+      self.assertEqual(len(pool.workers), 2)
+      idle = [w for w in pool.workers if w is not busy][0]
+      time.sleep(.4)
+      # still alive after the thread that started it is gone
+      self.assertIsNone(idle.child.poll())
+      pool.release(busy)
+      self.assertEqual(pool.workers, [busy])
+      self.assertIsNotNone(idle.child.wait(5))
+      # never below render_pool_min
+      time.sleep(.4)
+      pool.reap_idle()
+      self.assertEqual(pool.workers, [busy])
+    finally:
+      pool.close()
+
+  def test_contexts_start_without_holding_the_lock(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    class Child(object):
+      pid = None
+      def poll(self): return None
+      def terminate(self): pass
+      def kill(self): pass
+    builds = []
+    def build_js_context(deps):
+      builds.append(deps)
+      time.sleep(.5)
+      return '/nonexistent.sock', Child()
+    br.build_js_context = build_js_context
+    start = time.time()
+    threads = [threading.Thread(target=br.get_js_context, args=(deps,)) for deps in [('a',), ('b',), ('a',)]]
+    for t in threads: t.start()
+    time.sleep(.1)
+    with br._ctx_lock:
+      self.assertLess(time.time() - start, .3)
+    for t in threads: t.join()
+    self.assertLess(time.time() - start, .9)
+    self.assertEqual(sorted(builds), [('a',), ('b',)])
+    self.assertEqual(sorted(br._ctxs), [('a',), ('b',)])
+    self.assertEqual(br._ctx_futures, {})
+
+  def test_pool_spawns_without_holding_the_lock(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_pool_min=2, render_pool_max=2)
+    class Child(object):
+      pid = None
+      def poll(self): return None
+      def terminate(self): pass
+      def kill(self): pass
+    delay = [0]
+    def build_js_context(deps):
+      time.sleep(delay[0])
+      return '/nonexistent.sock', Child()
+    br.build_js_context = build_js_context
+    pool = br.get_js_context(('a',))
+    pool.remove(pool.workers[1])
+    delay[0] = .5
+    start = time.time()
+    acquired = []
+    threads = [threading.Thread(target=lambda: acquired.append(pool.acquire())) for i in range(2)]
+    for t in threads: t.start()
+    time.sleep(.1)
+    with pool._lock:
+      self.assertLess(time.time() - start, .3)
+    for t in threads: t.join()
+    self.assertEqual(len(pool.workers), 2)
+    self.assertEqual(len(acquired), 2)
+    # with no workers at all, acquire() waits for the one being started
+    for w in list(pool.workers): pool.remove(w)
+    threads = [threading.Thread(target=lambda: acquired.append(pool.acquire())) for i in range(3)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    self.assertEqual(len(pool.workers), 2)
+    self.assertEqual(len(acquired), 5)
+    pool.close()
+
+  def test_supervisor_respawns_and_recycles(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, metrics=True, render_supervise_interval=.1, render_recycle_after=3)
+    try:
+      br.render_html(br.HelloWorld(), render_server=True)
+      pool = list(br._ctxs.values())[0]
+      worker = pool.workers[0]
+      worker.child.kill()
+      for i in range(100):
+        if pool.workers and pool.workers[0] is not worker: break
+        time.sleep(.1)
+      self.assertIsNot(pool.workers[0], worker)
+      self.assertEqual(br.metrics()['counters']['context_respawns'], 1)
+      worker = pool.workers[0]
+      for i in range(3):
+        self.assertIn('Thanks for trying', br.render_html(br.HelloWorld({'i':i}), render_server=True))
+      for i in range(100):
+        if worker.child.poll() is not None: break
+        time.sleep(.1)
+      self.assertIsNotNone(worker.child.poll())
+      self.assertEqual(len(pool.workers), 1)
+      self.assertEqual(br.metrics()['counters']['context_recycles'], 1)
+      self.assertIn('Thanks for trying', br.render_html(br.HelloWorld(), render_server=True))
+    finally:
+      br.stop_supervising()
+      for pool in br._ctxs.values(): pool.close()
+
+  def test_hung_render_server(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, metrics=True, render_timeout=.5)
+    try:
+      br.render_html(br.HelloWorld(), render_server=True)
+      pool = list(br._ctxs.values())[0]
+      worker = pool.workers[0]
+      self.assertTrue(worker.ping(1))
+      os.kill(worker.child.pid, signal.SIGSTOP)
+      self.assertFalse(worker.ping(.2))
+      # the render times out, and is retried on a new server
+      start = time.time()
+      self.assertIn('Thanks for trying', br.render_html(br.HelloWorld({'i':1}), render_server=True))
+      self.assertLess(time.time() - start, 5)
+      self.assertNotEqual(worker.child.wait(5), None)
+      self.assertEqual(br.metrics()['counters']['render_retries'], 1)
+      # the supervisor replaces one that stops answering pings
+      worker = pool.workers[0]
+      os.kill(worker.child.pid, signal.SIGSTOP)
+      br.render_supervise_interval = .1
+      br.start_supervising()
+      for i in range(100):
+        if pool.workers and pool.workers[0] is not worker: break
+        time.sleep(.1)
+      self.assertIsNot(pool.workers[0], worker)
+      self.assertNotEqual(worker.child.wait(5), None)
+      self.assertEqual(br.metrics()['counters']['context_hangs'], 1)
+      self.assertIn('Thanks for trying', br.render_html(br.HelloWorld({'i':2}), render_server=True))
+    finally:
+      br.stop_supervising()
+      for pool in br._ctxs.values(): pool.close()
+
+  def test_replace_drains_busy_worker(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    br.render_html(br.HelloWorld(), render_server=True)
+    pool = list(br._ctxs.values())[0]
+    try:
+      worker = pool.acquire()
+      pool.replace(worker)
+      self.assertEqual(len(pool.workers), 1)
+      self.assertIsNot(pool.workers[0], worker)
+      # the old one finishes what it's doing first
+      self.assertIsNone(worker.child.poll())
+      self.assertIn(b'Thanks for trying', worker.request(br.HelloWorld().to_render_json().encode()))
+      pool.release(worker)
+      self.assertIsNotNone(worker.child.wait(5))
+      self.assertIn('Thanks for trying', br.render_html(br.HelloWorld(), render_server=True))
+    finally:
+      pool.close()
+
+  def test_request_stream_reuses_connection(self):
+    connections = []
+    class Handler(http.server.BaseHTTPRequestHandler):
+      protocol_version = 'HTTP/1.1'
+      def setup(self):
+        connections.append(1)
+        http.server.BaseHTTPRequestHandler.setup(self)
+      def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        self.send_response(200)
+        self.send_header('Content-Length', '5')
+        self.end_headers()
+        self.wfile.write(b'hello')
+      def log_message(self, *args):
+        pass
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+      daemon_threads = True
+    work = tempfile.mkdtemp()
+    server = Server(os.path.join(work, 'sock'), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+      worker = bottlereact._RenderWorker(os.path.join(work, 'sock'), None)
+      for i in range(5):
+        self.assertEqual(b''.join(worker.request_stream(b'[]')), b'hello')
+      self.assertEqual(len(connections), 1)
+    finally:
+      server.shutdown()
+      server.server_close()
+      shutil.rmtree(work)
+
+  def test_deep_tree(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_cache_size=10)
+    node = br.HelloWorld({'name':'leaf'}, ['a'])
+    for i in range(3000):
+      node = br.HelloWorld({'i':i}, [None, node, 'b'])
+    tree = node.to_render_tree()
+    for i in range(2999, -1, -1):
+      self.assertEqual(tree[:2], ['HelloWorld', {'i':i} if i == 2999 else {'i':i, 'key':'_br_1'}])
+      self.assertEqual(tree[2][1], 'b')
+      tree = tree[2][0]
+    self.assertEqual(tree, ['HelloWorld', {'name':'leaf', 'key':'_br_1'}, ['a']])
+    self.assertEqual(br.HelloWorld({}, [None, br.HelloWorld(), 'c']).to_render_tree(), json.loads(br.HelloWorld({}, [None, br.HelloWorld(), 'c']).to_render_json()))
+    self.assertEqual(node.get_js_files(), ['hello_world.jsx'] * 3001)
+    self.assertEqual(node.get_react_classes(), set(['HelloWorld']))
+    frozen = node.freeze()
+    br.render_html(br.HelloWorld({}, [frozen]))
+    self.assertEqual(br.HelloWorld({}, [frozen])._render_plan()[:2], (('hello_world.jsx',), frozenset(['HelloWorld'])))
+    br.invalidate_render_cache(node)
+
+  def test_long_work_path(self):
+    work = tempfile.mkdtemp()
+    long_work = os.path.join(work, 'x' * 100)
+    br = bottlereact.BottleReact(bottle.Bottle(), prod=True, work_path=long_work, verbose=False)
+    try:
+      html = br.render_html(br.HelloWorld(), render_server=True)
+      self.assertTrue('Thanks for trying' in html)
+      address = list(br._ctxs.values())[0].workers[0].address
+      self.assertFalse(address.startswith(long_work))
+      self.assertTrue(len(address.encode()) <= 103)
+    finally:
+      for pool in br._ctxs.values(): pool.close()
+      shutil.rmtree(work)
+      shutil.rmtree(br._short_socket_path)
+
+  def test_to_javascript(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    node = br.HelloWorld({'name':'</script>'}, ['a', None, br.HelloWorld()])
+    js = node.to_javascript()
+    self.assertTrue(js.startswith('React.createElement(bottlereact.HelloWorld,{"name":'))
+    self.assertTrue(',["a",React.createElement(bottlereact.HelloWorld,{"key":' in js)
+    self.assertTrue(js.endswith('"_br_2"},[])])'))
+    self.assertFalse('</' in js)
+    self.assertEqual(json.loads(node.to_render_json()), node.to_render_tree())
+    deep = br.HelloWorld()
+    for i in range(5000):
+      deep = br.HelloWorld(children=[deep])
+    self.assertEqual(deep.to_javascript().count('React.createElement'), 5001)
+
+  def test_frozen_subtree(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    nav = br.HelloWorld({'name':'nav'}).freeze()
+    js = br.HelloWorld(children=[nav]).to_javascript()
+    self.assertEqual(nav._memo[(True, '_br_0')], nav.to_javascript('_br_0'))
+    nav.props['name'] = 'changed' # frozen, so not noticed
+    self.assertEqual(br.HelloWorld(children=[nav]).to_javascript(), js)
+    with self.assertRaises(AttributeError):
+      nav.foo = 1
+
+  def test_render_shared_context(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_shared_context=True)
+    html = br.render_html(br.HelloWorld(), render_server=True)
+    self.assertTrue('Thanks for trying' in html)
+    br.render_server(['bottlereact.js', 'hello_world.jsx'], '["HelloWorld", {}, []]')
+    self.assertEqual(list(br._ctxs.keys()), [br._get_shared_deps()])
+
+  def test_render_max_contexts(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_max_contexts=1)
+    html = br.render_html(br.HelloWorld(), render_server=True)
+    old_pool = list(br._ctxs.values())[0]
+    child = old_pool.workers[0].child
+    deps = ['bottlereact.js', 'react-with-addons.js', 'hello_world.jsx']
+    self.assertTrue(b'Thanks for trying' in br.render_server(deps, '["HelloWorld", {}, []]'))
+    self.assertEqual(len(br._ctxs), 1)
+    self.assertTrue(old_pool.closed)
+    self.assertNotEqual(child.wait(5), None)
+
+  def test_render_max_contexts_concurrent_eviction(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_max_contexts=1)
+    br.build_js_context = stand_in_build_js_context(br)
+    errors = []
+    def f(deps):
+      for i in range(50):
+        try:
+          self.assertEqual(br.render_server(deps, '[]'), b'hello')
+        except Exception as e:
+          errors.append(e)
+    threads = [threading.Thread(target=f, args=(('dep%i' % i,),)) for i in range(4)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    self.assertEqual(errors, [])
+    self.assertEqual(len(br._ctxs), 1)
+    # also when the pool is closed between getting and using it
+    pool = list(br._ctxs.values())[0]
+    with br._ctx_lock:
+      del br._ctxs[pool.deps]
+    pool.close()
+    get_js_context = br.get_js_context
+    returned = []
+    br.get_js_context = lambda deps: returned.append(1) or (pool if len(returned) == 1 else get_js_context(deps))
+    self.assertEqual(br.render_server(pool.deps, '[]', retry=False), b'hello')
+    self.assertEqual(len(returned), 2)
+    for pool in br._ctxs.values(): pool.close()
+
+  def test_render_cache(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_cache_size=10)
+    html = br.render_html(br.HelloWorld({'name':'x'}), render_server=True)
+    for pool in br._ctxs.values(): pool.close()
+    br._ctxs.clear()
+    html2 = br.render_html(br.HelloWorld({'name':'x'}), render_server=True)
+    self.assertEqual(html, html2)
+    self.assertEqual(len(br._ctxs), 0)
+    self.assertEqual(len(br._render_cache), 1)
+    br.invalidate_render_cache(br.HelloWorld({'name':'x'}))
+    self.assertEqual(len(br._render_cache), 0)
+
+  def test_render_cache_limits(self):
+    cache = bottlereact._RenderCache(max_size=2, max_bytes=10)
+    cache.put('a', b'12345')
+    cache.put('b', b'12345')
+    self.assertEqual(cache.get('a'), b'12345')
+    cache.put('c', b'1')
+    self.assertEqual(cache.get('b'), None) # least recently used, over max_bytes
+    self.assertEqual(cache.get('a'), b'12345')
+    cache.put('d', b'1')
+    self.assertEqual(cache.get('c'), None) # over max_size
+    cache.put('e', b'12345678901')
+    self.assertEqual(cache.get('e'), None) # too big to cache
+    cache = bottlereact._RenderCache(max_size=2, ttl=-1)
+    cache.put('a', b'1')
+    self.assertEqual(cache.get('a'), None)
+
+  def test_render_html_async(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    async def f():
+      return await asyncio.gather(*[br.render_html_async(br.HelloWorld({'name':str(i)}), render_server=True) for i in range(5)])
+    htmls = asyncio.run(f())
+    for html in htmls:
+      self.assertTrue('Thanks for trying' in html)
+    self.assertEqual(htmls[0], br.render_html(br.HelloWorld({'name':'0'}), render_server=True))
+
+  def test_render_html_stream(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    chunks = br.render_html(br.HelloWorld(), render_server=True, stream=True)
+    head = next(chunks)
+    self.assertTrue('-bottlereact.js"></script>' in head)
+    self.assertFalse('Thanks for trying' in head)
+    html = head + ''.join(chunks)
+    self.assertEqual(html, br.render_html(br.HelloWorld(), render_server=True))
+    # without server side rendering the template sees no body
+    template = '{{! deps }}{{! init }}<div>{{! body or "Loading..." }}</div>'
+    html = ''.join(br.render_html(br.HelloWorld(), template=template, stream=True))
+    self.assertTrue('<div>Loading...</div>' in html)
+    self.assertEqual(html, br.render_html(br.HelloWorld(), template=template))
+
+  def test_prewarm(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, prewarm=True)
+    self.assertEqual(len(br._ctxs), 1)
+    pool = list(br._ctxs.values())[0]
+    self.assertEqual(pool.workers[0].child.poll(), None)
+    self.assertTrue(os.path.exists(pool.workers[0].address))
+    html = br.render_html(br.HelloWorld(), render_server=True)
+    self.assertTrue('Thanks for trying' in html)
+    self.assertEqual(list(br._ctxs.values()), [pool])
+
+  def test_prewarm_roots(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    br.prewarm(['HelloWorld', br.HelloWorld(children=[br.HelloWorld()])])
+    self.assertEqual(len(br._ctxs), 1)
+
+  def test_render_tree(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    node = br.HelloWorld({'name':'x'}, ['a', None, br.HelloWorld()])
+    name, props, children = node.to_render_tree()
+    self.assertEqual(name, 'HelloWorld')
+    self.assertEqual(props['name'], 'x')
+    self.assertEqual(children[0], 'a')
+    self.assertEqual(children[1][0], 'HelloWorld')
+    self.assertEqual(len(children), 2)
+
+  def test_server_side_render_props(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    html = br.render_html(br.HelloWorld({'name':'</script>'}), render_server=True)
+    self.assertTrue('&lt;/script&gt;' in html)
+
+  def test_render_server_reuses_connection(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True)
+    br.render_html(br.HelloWorld(), render_server=True)
+    worker = list(br._ctxs.values())[0].workers[0]
+    self.assertTrue(worker.address.endswith('.sock'))
+    self.assertEqual(len(worker._conns), 1)
+    conn = worker._conns[0]
+    html = br.render_html(br.HelloWorld(), render_server=True)
+    self.assertTrue('Thanks for trying' in html)
+    self.assertEqual(worker._conns, [conn])
+
+  def test_render_pool_scales_up(self):
+    app = bottle.Bottle()
+    br = bottlereact.BottleReact(app, prod=True, render_pool_min=1, render_pool_max=2)
+    html = br.render_html(br.HelloWorld(), render_server=True)
+    pool = list(br._ctxs.values())[0]
+    self.assertEqual(len(pool.workers), 1)
+    busy = pool.acquire()
+    other = pool.acquire()
+    self.assertTrue(busy is other) # only one worker yet, the second is starting
+    pool.release(busy)
+    pool.release(other)
+    for i in range(100):
+      if len(pool.workers) == 2: break
+      time.sleep(.1)
+    self.assertEqual(len(pool.workers), 2)
+    self.assertTrue(pool.acquire() is not pool.acquire())
+    pool.close()
     
 
 